@@ -82,6 +82,10 @@ import xode.transform
 import volumetricutils
 
 from multiprocessing import Process, Queue
+import multiprocessing
+import os
+import tempfile
+import time
 
 from sklearn.cluster import DBSCAN
 from sklearn import metrics
@@ -127,6 +131,12 @@ def getGraspQHull(points, openrave_grasper):
 #        print points
     return planes
 
+def getFingerPointsArray(points, pos):
+        # (N,3) array of positions of the finger points relative to pos
+        if len(points) == 0:
+            return np.zeros((0,3))
+        return np.array([[pt[1][0], pt[1][1], pt[1][2]] for pt in points]) - np.array([pos[0], pos[1], pos[2]])
+
 def KDLToOpenrave(T):
         ret = numpy.array([
         [T.M[0,0], T.M[0,1], T.M[0,2], T.p.x()],
@@ -140,6 +150,58 @@ def OpenraveToKDL(T):
         pos = PyKDL.Vector(T[0][3], T[1][3], T[2][3])
         return PyKDL.Frame(rot, pos)
 
+def getSelfCollisionConfigs(openrave_robot, dof_configs, sp_idx, f1_idx):
+    # self-colliding configurations (sp_idx, f1_idx, f3_idx, f2_idx) for all
+    # f2 and f3 values
+    sp_configs, f1_configs, f3_configs, f2_configs = dof_configs
+    sp = sp_configs[sp_idx]
+    f1 = f1_configs[f1_idx]
+    configs = []
+    for f2_idx in range(len(f2_configs)):
+        f2 = f2_configs[f2_idx]
+        for f3_idx in range(len(f3_configs)):
+            f3 = f3_configs[f3_idx]
+            openrave_robot.SetDOFValues([sp/180.0*math.pi, f1/180.0*math.pi, f3/180.0*math.pi, f2/180.0*math.pi])
+            if openrave_robot.CheckSelfCollision():
+                configs.append( (sp_idx, f1_idx, f3_idx, f2_idx) )
+    return configs
+
+def getSelfCollisionShardFilename(shards_dir, shard):
+    return os.path.join(shards_dir, "self_collision_%s_%s.txt"%(shard[0], shard[1]))
+
+def readSelfCollisionShard(filename):
+    configs = []
+    with open(filename, 'r') as f:
+        for line in f:
+            cf_str = line.split()
+            if len(cf_str) == 4:
+                configs.append( (int(cf_str[0]), int(cf_str[1]), int(cf_str[2]), int(cf_str[3])) )
+    return configs
+
+# OpenRAVE environment of the worker process, set by initSelfCollisionWorker
+self_collision_worker_data = None
+
+def initSelfCollisionWorker(env_filename, dof_configs, shards_dir):
+    # every worker loads its own copy of the scene
+    global self_collision_worker_data
+    env = Environment()
+    env.Load(env_filename)
+    self_collision_worker_data = (env, env.GetRobots()[0], dof_configs, shards_dir)
+
+def generateSelfCollisionShard(shard):
+    # the shard is written to its file when it is complete, so an
+    # interrupted generation may be resumed
+    env, openrave_robot, dof_configs, shards_dir = self_collision_worker_data
+    t0 = time.time()
+    with env:
+        configs = getSelfCollisionConfigs(openrave_robot, dof_configs, shard[0], shard[1])
+    fd, tmp_filename = tempfile.mkstemp(dir=shards_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        for cf in configs:
+            f.write(str(cf[0]) + " " + str(cf[1]) + " " + str(cf[2]) + " " + str(cf[3]) + "\n")
+    os.rename(tmp_filename, getSelfCollisionShardFilename(shards_dir, shard))
+    return shard, len(configs), time.time() - t0
+
 class GripperLinkGeometricModel:
     def __init__(self, name, openrave_robot, openrave_grasper):
         link = openrave_robot.GetLink(name)
@@ -148,29 +210,14 @@ class GripperLinkGeometricModel:
         faces = col.indices
 
         print "sampling the surface..."
-        self.surface_points = surfaceutils.sampleMeshDetailedRays(vertices, faces, 0.0015)
+        self.surface_points = surfaceutils.sampleMeshCached(vertices, faces, 0.0015, curvature_radius=0.003)
         print "surface has %s points"%(len(self.surface_points))
 
-        surface_points_init = []
-        for sp in self.surface_points:
-            surface_points_init.append(sp)
-
-        p_idx = random.randint(0, len(self.surface_points)-1)
         p_dist = 0.004
 
         print "generating a subset of surface points..."
 
-        self.sampled_points = []
-        while True:
-            self.sampled_points.append(p_idx)
-            surface_points2 = []
-            for sp in surface_points_init:
-                if (sp.pos-self.surface_points[p_idx].pos).Norm() > p_dist:
-                    surface_points2.append(sp)
-            if len(surface_points2) == 0:
-                break
-            surface_points_init = surface_points2
-            p_idx = surface_points_init[0].id
+        self.sampled_points = surfaceutils.getSeparatedSubset(self.surface_points.positions, p_dist)
 
         print "subset size: %s"%(len(self.sampled_points))
 
@@ -183,28 +230,6 @@ class GripperLinkGeometricModel:
         print "link qhull planes: %s"%(len(self.qhull_planes))
 
 
-#        T_W_O = PyKDL.Frame(PyKDL.Vector(0,0,0.5))
-        for pt_idx in self.sampled_points:
-                indices, nx, pc1, pc2 = surfaceutils.pclPrincipalCurvaturesEstimation(self.surface_points, pt_idx, 5, 0.003)
-#                m_id = self.pub_marker.publishVectorMarker(T_W_O * surface_points[pt_idx].pos, T_W_O * (surface_points[pt_idx].pos + nx*0.004), m_id, 1, 0, 0, frame='world', namespace='default', scale=0.0002)
-#                m_id = self.pub_marker.publishVectorMarker(T_W_O * surface_points[pt_idx].pos, T_W_O * (surface_points[pt_idx].pos + surface_points[pt_idx].normal*0.004), m_id, 0, 0, 1, frame='world', namespace='default', scale=0.0002)
-
-                self.surface_points[pt_idx].frame = PyKDL.Frame(PyKDL.Rotation(nx, self.surface_points[pt_idx].normal * nx, self.surface_points[pt_idx].normal), self.surface_points[pt_idx].pos)
-                self.surface_points[pt_idx].pc1 = pc1
-                self.surface_points[pt_idx].pc2 = pc2
-                if pc1 < 0.2:
-                    self.surface_points[pt_idx].is_plane = True
-                    self.surface_points[pt_idx].is_edge = False
-                    self.surface_points[pt_idx].is_point = False
-                elif pc2 < 0.2:
-                    self.surface_points[pt_idx].is_plane = False
-                    self.surface_points[pt_idx].is_edge = True
-                    self.surface_points[pt_idx].is_point = False
-                else:
-                    self.surface_points[pt_idx].is_plane = False
-                    self.surface_points[pt_idx].is_edge = False
-                    self.surface_points[pt_idx].is_point = True
-
         print "generating a set of interior points..."
         margin = 0.002
 #            vertices_min, vertices_max = velmautils.getMeshBB(vertices, faces)
@@ -217,6 +242,13 @@ class GripperLinkGeometricModel:
 
         print "points_in_link: %s"%(len(self.points_in_link))
 
+        # arrays of the sampled points for GripperModel.getSurfacePointsForConfig
+        self.sampled_positions = self.surface_points.positions[self.sampled_points]
+        self.sampled_normals = self.surface_points.normals[self.sampled_points].astype(np.float64)
+        self.sampled_types = self.surface_points.surface_type[self.sampled_points]
+        self.points_in_link_array = np.array([[pt[0], pt[1], pt[2]] for pt in self.points_in_link]).reshape(-1, 3)
+        self.qhull_planes_array = np.asarray(self.qhull_planes, dtype=np.float64).reshape(-1, 4)
+
 class GripperLinkModel:
     def __init__(self, name, link_geom):
         self.name = name
@@ -262,10 +294,109 @@ class GripperModel:
         self.dof_configs = (self.sp_configs, self.f1_configs, self.f3_configs, self.f2_configs)
         self.dof_limits = self.openrave_robot.GetDOFLimits()
 
+        # links in the table of link poses and the dofs of their fingers
+        self.link_pose_names = [
+        "right_HandPalmLink",
+        "right_HandFingerOneKnuckleOneLink",
+        "right_HandFingerOneKnuckleTwoLink",
+        "right_HandFingerOneKnuckleThreeLink",
+        "right_HandFingerTwoKnuckleOneLink",
+        "right_HandFingerTwoKnuckleTwoLink",
+        "right_HandFingerTwoKnuckleThreeLink",
+        "right_HandFingerThreeKnuckleTwoLink",
+        "right_HandFingerThreeKnuckleThreeLink",
+        ]
+        self.link_pose_dofs = [None, 1, 1, 1, 3, 3, 3, 2, 2]
+        self.link_poses = None
+
+    def getLinkPosesForIdx(self, sp_idx, f_idx):
+        # (2, links, 4, 4) array of the palm-relative transforms of the links
+        # for the spread sp_idx and the value f_idx of every finger (indexed by
+        # its own configs, the last value is used if the finger has fewer
+        # configs); [1] is for the fingers values increased by 0.01 rad
+        cf_values = [0, 0, 0, 0]
+        for dof in range(4):
+            configs = self.dof_configs[dof]
+            cf_values[dof] = configs[min(sp_idx if dof == 0 else f_idx, len(configs)-1)]/180.0*math.pi
+        cf_values_add = list(cf_values)
+        for dof in range(1, 4):
+            if cf_values[dof] + 0.01 <= self.dof_limits[1][dof]:
+                cf_values_add[dof] = cf_values[dof] + 0.01
+        link_poses = np.zeros((2, len(self.link_pose_names), 4, 4))
+        T_E_W = np.linalg.inv(self.openrave_robot.GetLink("right_HandPalmLink").GetTransform())
+        for pose_idx, values in ((0, cf_values), (1, cf_values_add)):
+            self.openrave_robot.SetDOFValues(values)
+            for link_idx in range(len(self.link_pose_names)):
+                link_poses[pose_idx, link_idx] = np.dot(T_E_W, self.openrave_robot.GetLink(self.link_pose_names[link_idx]).GetTransform())
+        return link_poses
+
+    def generateLinkPoses(self):
+        # (2, links, sp configs, fx configs, 4, 4) array of the link poses (see
+        # getLinkPosesForIdx) for all discretized values of the spread and of
+        # the fingers; the fx dimension has the size of the longest finger
+        # configs list, the links of each finger use only their own part of it
+        fx_count = max(len(self.f1_configs), len(self.f2_configs), len(self.f3_configs))
+        link_poses = np.zeros((2, len(self.link_pose_names), len(self.sp_configs), fx_count, 4, 4))
+        dof_values = self.openrave_robot.GetDOFValues()
+        for sp_idx in range(len(self.sp_configs)):
+            for f_idx in range(fx_count):
+                link_poses[:, :, sp_idx, f_idx] = self.getLinkPosesForIdx(sp_idx, f_idx)
+        self.openrave_robot.SetDOFValues(dof_values)
+        return link_poses
+
+    def checkLinkPoses(self, link_poses):
+        # compares the table with the current kinematics of the robot for a
+        # few reference configs (the first, middle and last values)
+        dof_values = self.openrave_robot.GetDOFValues()
+        sp_count, fx_count = link_poses.shape[2], link_poses.shape[3]
+        result = True
+        for sp_idx, f_idx in ((0, 0), (sp_count//2, fx_count//2), (sp_count-1, fx_count-1)):
+            if not np.allclose(link_poses[:, :, sp_idx, f_idx], self.getLinkPosesForIdx(sp_idx, f_idx), rtol=0.0, atol=1e-9):
+                result = False
+                break
+        self.openrave_robot.SetDOFValues(dof_values)
+        return result
+
+    def loadLinkPoses(self, filename):
+        # the table of link poses is generated once and saved to file; it is
+        # generated again if the links, the discretization or the kinematics
+        # of the robot have changed
+        if os.path.exists(filename):
+            with np.load(filename) as data:
+                configs_ok = True
+                for name, configs in (('sp_configs', self.sp_configs), ('f1_configs', self.f1_configs), ('f2_configs', self.f2_configs), ('f3_configs', self.f3_configs)):
+                    if not name in data.files or not np.array_equal(data[name], configs):
+                        configs_ok = False
+                link_names = data['link_names'].tolist()
+                link_poses = data['link_poses'] if configs_ok and link_names == self.link_pose_names else None
+            if link_poses is not None:
+                if self.checkLinkPoses(link_poses):
+                    self.link_poses = link_poses
+                    print "link poses loaded from file %s"%(filename)
+                    return
+                print "WARNING: loadLinkPoses: link poses in file %s do not match the kinematics of the robot"%(filename)
+        print "generating link poses..."
+        self.link_poses = self.generateLinkPoses()
+        np.savez(filename, link_poses=self.link_poses, link_names=np.array(self.link_pose_names), sp_configs=np.array(self.sp_configs),
+            f1_configs=np.array(self.f1_configs), f2_configs=np.array(self.f2_configs), f3_configs=np.array(self.f3_configs))
+        print "link poses saved to file %s"%(filename)
+
+    def getLinkPose(self, link_name, cf, next_pose=False):
+        # palm-relative 4x4 transform of the link for the config indices
+        # (sp_idx, f1_idx, f3_idx, f2_idx); None spread is treated as the
+        # first spread value (finger three does not depend on the spread)
+        if self.link_poses is None:
+            self.link_poses = self.generateLinkPoses()
+        link_idx = self.link_pose_names.index(link_name)
+        dof = self.link_pose_dofs[link_idx]
+        sp_idx = 0 if cf[0] == None else cf[0]
+        f_idx = 0 if dof == None else cf[dof]
+        return self.link_poses[1 if next_pose else 0, link_idx, sp_idx, f_idx]
+
     def getAnglesForConfigIdx(self, cf_idx):
         return np.array( [ self.sp_configs[cf_idx[0]], self.f1_configs[cf_idx[1]], self.f3_configs[cf_idx[2]], self.f2_configs[cf_idx[3]] ] )
 
-    def getSurfacePointsForConfig(self, cf, T_E_W):
+    def getSurfacePointsForConfig(self, cf):
 
 
         config_link_map = {}
@@ -273,13 +404,9 @@ class GripperModel:
         config_link_map[(0,3)] = [1, ["right_HandFingerTwoKnuckleThreeLink", "right_HandFingerTwoKnuckleTwoLink"]]
         config_link_map[(2,)] = [2, [ "right_HandFingerThreeKnuckleThreeLink", "right_HandFingerThreeKnuckleTwoLink"]]
 
-        non_actuated_joints = (0,)
-
         points = []
         points_forbidden = []
 
-        cf_values = [0,0,0,0]
-        cf_values_add = [0,0,0,0]
         valid_values = None
         for cf_idx in range(len(cf)):
             if cf[cf_idx] != None:
@@ -287,78 +414,51 @@ class GripperModel:
                     valid_values = (cf_idx,)
                 else:
                     valid_values = valid_values + (cf_idx,)
-                cf_values[cf_idx] = self.dof_configs[cf_idx][cf[cf_idx]]/180.0*math.pi
-                if cf_idx in non_actuated_joints:
-                    cf_values_add[cf_idx] = cf_values[cf_idx]
-                else:
-                    cf_values_add[cf_idx] = cf_values[cf_idx] + 0.01
-                    if cf_values_add[cf_idx] > self.dof_limits[1][cf_idx]:
-                        cf_values_add[cf_idx] = cf_values[cf_idx]
-
-        T_E_L = {}
-        T_L_E = {}
-        TR_E_L ={}
-        self.openrave_robot.SetDOFValues(cf_values)
-        for link_name in config_link_map[valid_values][1]:
-            link = self.openrave_robot.GetLink(link_name)
-            T_E_L[link_name] = T_E_W * OpenraveToKDL(link.GetTransform())
-            T_L_E[link_name] = T_E_L[link_name].Inverse()
-            TR_E_L[link_name] = PyKDL.Frame(T_E_L[link_name].M)
-
-        T_E_L_next = {}
-        self.openrave_robot.SetDOFValues(cf_values_add)
-        for link_name in config_link_map[valid_values][1]:
-            link = self.openrave_robot.GetLink(link_name)
-            T_E_L_next[link_name] = T_E_W * OpenraveToKDL(link.GetTransform())
 
+        finger_idx = config_link_map[valid_values][0]
         for link_name in config_link_map[valid_values][1]:
-            for pt_idx in self.links[link_name].link_geom.sampled_points:
-                pt_L = self.links[link_name].link_geom.surface_points[pt_idx]
-                pt_E = T_E_L[link_name] * pt_L.pos
-                pt_remove = True
-                for int_name in self.links[link_name].intersecting_links:
-                    pt_L_int = T_L_E[int_name] * pt_E
-                    for pl in self.links[int_name].link_geom.qhull_planes:
-                        if pt_L_int[0] * pl[0] + pt_L_int[1] * pl[1] + pt_L_int[2] * pl[2] + pl[3] > 0:
-                             pt_remove = False
-                             break
-                    if pt_remove:
-                        break
-                if pt_remove:
-                    continue
-                pt_E_next = T_E_L_next[link_name] * pt_L.pos
-                v_E = pt_E_next - pt_E
-                v_E.Normalize()
-                n_E = TR_E_L[link_name] * pt_L.normal
-                if PyKDL.dot(v_E, n_E) > 0.5:
-                    direction = 1
-                elif PyKDL.dot(v_E, n_E) < -0.5:
-                    direction = -1
-                else:
-                    direction = 0
-
-                if pt_L.is_plane == True:
-                    surf_type = 0
-                elif pt_L.is_edge == True:
-                    surf_type = 1
-                elif pt_L.is_point == True:
-                    surf_type = 2
-                else:
-                    print "ERROR: getSurfacePointsForConfig: unknown surface type"
-                points.append( (config_link_map[valid_values][0], pt_E, n_E, surf_type, cf, direction) )
-            for pt_L in self.links[link_name].link_geom.points_in_link:
-                pt_E = T_E_L[link_name] * pt_L
-                points_forbidden.append( (config_link_map[valid_values][0], pt_E, None, None, cf, None) )
+            link_geom = self.links[link_name].link_geom
+            T_E_L = self.getLinkPose(link_name, cf)
+            T_E_L_next = self.getLinkPose(link_name, cf, next_pose=True)
+            pt_E = np.dot(link_geom.sampled_positions, T_E_L[:3,:3].T) + T_E_L[:3,3]
+
+            # remove the points that lie inside the qhull of an intersecting
+            # link: (points x 4) . (4 x planes) for each intersecting link
+            pt_E_h = np.column_stack((pt_E, np.ones(len(pt_E))))
+            pt_valid = np.ones(len(pt_E), dtype=bool)
+            for int_name in self.links[link_name].intersecting_links:
+                T_E_L_int = self.getLinkPose(int_name, cf)
+                T_L_E_int = np.identity(4)
+                T_L_E_int[:3,:3] = T_E_L_int[:3,:3].T
+                T_L_E_int[:3,3] = -np.dot(T_E_L_int[:3,:3].T, T_E_L_int[:3,3])
+                pt_L_int = np.dot(pt_E_h, T_L_E_int.T)
+                pt_valid &= np.any(np.dot(pt_L_int, self.links[int_name].link_geom.qhull_planes_array.T) > 0, axis=1)
+
+            # directions of the points movement relative to the normals
+            v_E = np.dot(link_geom.sampled_positions[pt_valid], T_E_L_next[:3,:3].T) + T_E_L_next[:3,3] - pt_E[pt_valid]
+            v_norm = np.sqrt(np.sum(v_E * v_E, axis=1))
+            # the same as PyKDL.Vector.Normalize: (nearly) zero vectors get (1,0,0)
+            still = v_norm < 1e-6
+            v_E /= np.where(still, 1.0, v_norm).reshape(-1, 1)
+            v_E[still] = [1.0, 0.0, 0.0]
+            n_E = np.dot(link_geom.sampled_normals[pt_valid], T_E_L[:3,:3].T)
+            v_dot_n = np.sum(v_E * n_E, axis=1)
+            directions = np.where(v_dot_n > 0.5, 1, np.where(v_dot_n < -0.5, -1, 0))
+
+            surf_types = link_geom.sampled_types[pt_valid]
+            if np.any(surf_types == surfaceutils.SurfacePointCloud.TYPE_UNKNOWN):
+                print "ERROR: getSurfacePointsForConfig: unknown surface type"
+
+            for pt, n, surf_type, direction in zip(pt_E[pt_valid].tolist(), n_E.tolist(), surf_types.tolist(), directions.tolist()):
+                points.append( (finger_idx, PyKDL.Vector(pt[0], pt[1], pt[2]), PyKDL.Vector(n[0], n[1], n[2]), surf_type, cf, direction) )
+            for pt in (np.dot(link_geom.points_in_link_array, T_E_L[:3,:3].T) + T_E_L[:3,3]).tolist():
+                points_forbidden.append( (finger_idx, PyKDL.Vector(pt[0], pt[1], pt[2]), None, None, cf, None) )
         return points, points_forbidden
 
     def generateSamples(self):
         points = []
         points_forbidden = []
 
-        T_W_E = OpenraveToKDL(self.openrave_robot.GetLink("right_HandPalmLink").GetTransform())
-        TR_W_E = PyKDL.Frame(T_W_E.M)
-        T_E_W = T_W_E.Inverse()
-
         configs = []
         for sp_idx in range(len(self.sp_configs)):
             for f1_idx in range(len(self.f1_configs)):
@@ -370,7 +470,7 @@ class GripperModel:
 
         print "generateSamples: configs: %s"%(len(configs))
         for cf in configs:
-            p, pf = self.getSurfacePointsForConfig(cf, T_E_W)
+            p, pf = self.getSurfacePointsForConfig(cf)
             points += p
             points_forbidden += pf
         return points, points_forbidden
@@ -379,16 +479,40 @@ class GripperModel:
         self_collisions_configs = set()
         for sp_idx in range(len(self.sp_configs)):
             print "%s / %s"%(sp_idx, len(self.sp_configs))
-            sp = self.sp_configs[sp_idx]
             for f1_idx in range(len(self.f1_configs)):
-                f1 = self.f1_configs[f1_idx]
-                for f2_idx in range(len(self.f2_configs)):
-                    f2 = self.f2_configs[f2_idx]
-                    for f3_idx in range(len(self.f3_configs)):
-                        f3 = self.f3_configs[f3_idx]
-                        self.openrave_robot.SetDOFValues([sp/180.0*math.pi, f1/180.0*math.pi, f3/180.0*math.pi, f2/180.0*math.pi])
-                        if self.openrave_robot.CheckSelfCollision():
-                            self_collisions_configs.add( (sp_idx, f1_idx, f3_idx, f2_idx) )
+                self_collisions_configs.update( getSelfCollisionConfigs(self.openrave_robot, self.dof_configs, sp_idx, f1_idx) )
+        return self_collisions_configs
+
+    def generateSelfCollisionDataParallel(self, env_filename, shards_dir, workers_count=4):
+        # the configurations are split into (sp_idx, f1_idx) shards checked by
+        # the workers, each with its own OpenRAVE environment loaded from
+        # env_filename; completed shards are kept in shards_dir and skipped
+        # when the generation is run again
+        if not os.path.isdir(shards_dir):
+            os.makedirs(shards_dir)
+        shards = []
+        for sp_idx in range(len(self.sp_configs)):
+            for f1_idx in range(len(self.f1_configs)):
+                shards.append( (sp_idx, f1_idx) )
+        remaining_shards = [shard for shard in shards if not os.path.exists(getSelfCollisionShardFilename(shards_dir, shard))]
+        print "self collision shards: %s, already done: %s"%(len(shards), len(shards) - len(remaining_shards))
+
+        if len(remaining_shards) > 0:
+            t0 = time.time()
+            pool = multiprocessing.Pool(workers_count, initializer=initSelfCollisionWorker, initargs=(env_filename, self.dof_configs, shards_dir))
+            try:
+                done = 0
+                for shard, configs_count, shard_time in pool.imap_unordered(generateSelfCollisionShard, remaining_shards):
+                    done += 1
+                    print "self collision shard %s / %s: sp %s f1 %s, collisions: %s, time: %ss"%(done, len(remaining_shards), shard[0], shard[1], configs_count, shard_time)
+            finally:
+                pool.close()
+                pool.join()
+            print "self collision checking time: %ss"%(time.time() - t0)
+
+        self_collisions_configs = set()
+        for shard in shards:
+            self_collisions_configs.update( readSelfCollisionShard(getSelfCollisionShardFilename(shards_dir, shard)) )
         return self_collisions_configs
 
 class VolumetricGrasp:
@@ -844,16 +968,6 @@ Class for grasp learning.
             for cf in self_collisions_configs:
                 f.write(str(cf[0]) + " " + str(cf[1]) + " " + str(cf[2]) + " " + str(cf[3]) + "\n")
 
-    def loadSelfCollisionData(self, filename):
-        self_collisions_configs = set()
-        with open(filename, 'r') as f:
-            while True:
-                cf_str = f.readline().split()
-                if len(cf_str) != 4:
-                    break
-                self_collisions_configs.add( (int(cf_str[0]), int(cf_str[1]), int(cf_str[2]), int(cf_str[3])) )
-        return self_collisions_configs
-
     def visualize1(self, T_W_H, joint_map, points_for_config, ori_for_config, vol_obj, sp_configs, f1_configs, f2_configs, f3_configs, pub_marker):
                   for cf in points_for_config:
                       # update the gripper visualization in ros
@@ -873,14 +987,15 @@ Class for grasp learning.
                           rospy.sleep(0.1)
 
                       pub_marker.eraseMarkers(0,6000, frame_id='world')
-                      print "orientations: %s"%(len(ori_for_config[cf]))
+                      oris = volumetricutils.getOrientationsFromBits(ori_for_config[cf]).tolist()
+                      print "orientations: %s"%(len(oris))
                       m_id = 0
-                      for ori in ori_for_config[cf]:
+                      for ori in oris:
                           T_W_O = T_W_H * vol_obj.orientations[ori] * vol_obj.T_H_O
                           m_id = pub_marker.publishConstantMeshMarker("package://barrett_hand_defs/meshes/objects/klucz_gerda_binary.stl", m_id, r=1, g=0, b=0, scale=1.0, frame_id='world', namespace='default', T=T_W_O)
                           rospy.sleep(0.001)
 
-                      for ori in ori_for_config[cf]:
+                      for ori in oris:
                           o_q = orientations[ori].M.GetQuaternion()
                           o_pt = PyKDL.Vector(o_q[0], o_q[1], o_q[2])
                           m_id = pub_marker.publishSinglePointMarker(PyKDL.Vector(0,0,0.6) + o_pt*0.1, m_id, r=0, g=o_q[3], b=0, namespace='default', frame_id='world', m_type=Marker.CUBE, scale=Vector3(0.003, 0.003, 0.003), T=None)
@@ -891,7 +1006,7 @@ Class for grasp learning.
                           if ch == 'n':
                               break
                           pub_marker.eraseMarkers(0,6000, frame_id='world')
-                          ori = random.choice(tuple(ori_for_config[cf]))
+                          ori = random.choice(oris)
                           T_W_O = T_W_H * vol_obj.orientations[ori] * vol_obj.T_H_O
                           m_id = pub_marker.publishConstantMeshMarker("package://barrett_hand_defs/meshes/objects/klucz_gerda_binary.stl", m_id, r=0, g=1, b=0, scale=1.0, frame_id='world', namespace='default', T=T_W_O)
 
@@ -1065,24 +1180,21 @@ Class for grasp learning.
               ori_for_config = {}
               points_for_config2 = {}
               # for each config calculate valid orientations
+              # the sets of orientations are packed bitsets (see volumetricutils)
               for cf in points_for_config:
-                  allowed_ori = set()
-                  forbidden_ori = set()
+                  forbidden_ori = vol_obj.getEmptyOrientationBits()
 
                   if cf in points_f_for_config:
-                      for f_pt_f in points_f_for_config[cf]:
-                          vol_idx = vol_obj.getVolIndex(f_pt_f[1]-pos)
-                          vol_sample = vol_obj.vol_samples[vol_idx[0]][vol_idx[1]][vol_idx[2]]
-                          forbidden_ori = forbidden_ori.union(set(vol_sample.keys()))
-
-                  for f_pt in points_for_config[cf]:
-                      vol_idx = vol_obj.getVolIndex(f_pt[1]-pos)
-                      vol_sample = vol_obj.vol_samples[vol_idx[0]][vol_idx[1]][vol_idx[2]]
-                      oris_to_check = set(vol_sample.keys())
-                      allowed_ori = allowed_ori.union(oris_to_check)
-
-                  ori = allowed_ori.difference(forbidden_ori)
-                  if len(ori) > 0:
+                      vol_idx, valid = vol_obj.getVolIndices(getFingerPointsArray(points_f_for_config[cf], pos))
+                      vol_idx = vol_idx[valid]
+                      forbidden_ori = vol_obj.getOrientationBits(vol_obj.getVolLinearIndex(vol_idx[:,0], vol_idx[:,1], vol_idx[:,2]))
+
+                  vol_idx, valid = vol_obj.getVolIndices(getFingerPointsArray(points_for_config[cf], pos))
+                  vol_idx = vol_idx[valid]
+                  allowed_ori = vol_obj.getOrientationBits(vol_obj.getVolLinearIndex(vol_idx[:,0], vol_idx[:,1], vol_idx[:,2]))
+
+                  ori = allowed_ori & ~forbidden_ori
+                  if np.any(ori):
                       ori_for_config[cf] = ori
                       points_for_config2[cf] = points_for_config[cf]
               return ori_for_config, points_for_config2
@@ -1113,11 +1225,24 @@ Class for grasp learning.
               good_configs = {}
               forbidden_cf_ori = {}
               for cf1 in points_for_config_f1:
-                  forbidden_cf_ori[cf1] = set()
+                  forbidden_cf_ori[cf1] = vol_obj.getEmptyOrientationBits()
               for cf2 in points_for_config_f2:
-                  forbidden_cf_ori[cf2] = set()
+                  forbidden_cf_ori[cf2] = vol_obj.getEmptyOrientationBits()
               for cf3 in points_for_config_f3:
-                  forbidden_cf_ori[cf3] = set()
+                  forbidden_cf_ori[cf3] = vol_obj.getEmptyOrientationBits()
+
+              # voxels of the volumetric model for all points of each config,
+              # and their linear indices (-1 for the points outside the volume)
+              vol_idx_for_config = {}
+              vol_lin_for_config = {}
+              for cfx in points_for_config2:
+                  vol_idx, valid = vol_obj.getVolIndices(getFingerPointsArray(points_for_config2[cfx], pos))
+                  vol_lin_for_config[cfx] = np.where(valid, vol_obj.getVolLinearIndex(vol_idx[:,0], vol_idx[:,1], vol_idx[:,2]), -1)
+                  vol_idx = vol_idx.tolist()
+                  for f_pt_idx in range(len(vol_idx)):
+                      if not valid[f_pt_idx]:
+                          vol_idx[f_pt_idx] = None
+                  vol_idx_for_config[cfx] = vol_idx
 
               normals_for_config = {}
               contacts_obj_for_config = {}
@@ -1126,6 +1251,14 @@ Class for grasp learning.
               dir_link_for_config = {}
               is_plane_obj_config = {}
 
+              # self collision configs among all combinations of the fingers configs
+              cf1_array = np.array([[cf1[0], cf1[1]] for cf1 in points_for_config_f1], dtype=np.int64).reshape(-1, 2)
+              cf2_array = np.array([[cf2[0], cf2[3]] for cf2 in points_for_config_f2], dtype=np.int64).reshape(-1, 2)
+              cf3_array = np.array([cf3[2] for cf3 in points_for_config_f3], dtype=np.int64)
+              cf1_idx, cf2_idx = np.nonzero(cf1_array[:,0].reshape(-1, 1) == cf2_array[:,0].reshape(1, -1))
+              configs = np.column_stack((np.repeat(cf1_array[cf1_idx], len(cf3_array), axis=0), np.tile(cf3_array, len(cf1_idx)), np.repeat(cf2_array[cf2_idx,1], len(cf3_array))))
+              self_collision_cf = set(tuple(cf) for cf in configs[self_collisions_configs.contains(configs)].tolist())
+
               # iterate through all locally possible hand configs
               for cf1 in points_for_config_f1:
                 for cf2 in points_for_config_f2:
@@ -1136,34 +1269,45 @@ Class for grasp learning.
                       cf = (cf1[0], cf1[1], cf3[2], cf2[3])
 
                       # eliminate self collision configs
-                      if cf in self_collisions_configs:
+                      if cf in self_collision_cf:
                           continue
 
                       # get the intersection of the orientations set for contact of the object with each of the fingers
-                      ori_set = ori_for_config[cf1].intersection(ori_for_config[cf2], ori_for_config[cf3])
-                      ori_set = ori_set.difference(forbidden_cf_ori[cf1], forbidden_cf_ori[cf2], forbidden_cf_ori[cf3])
+                      ori_set = ori_for_config[cf1] & ori_for_config[cf2] & ori_for_config[cf3]
+                      ori_set &= ~(forbidden_cf_ori[cf1] | forbidden_cf_ori[cf2] | forbidden_cf_ori[cf3])
 
                       # perform additional checks for each possible orientation
                       ori_set_ok = []
-                      for ori_idx in ori_set:
+                      for ori_idx in volumetricutils.getOrientationsFromBits(ori_set).tolist():
 
                           T_E_O = TT_E_H * vol_obj.orientations[ori_idx] * vol_obj.T_H_O
                           TR_E_O = PyKDL.Frame(T_E_O.M)
 
                           for cfx in [cf1, cf2, cf3]:
                               ori_ok = False
-                              if ori_idx in forbidden_cf_ori[cfx]:
+                              if volumetricutils.testOrientationBit(forbidden_cf_ori[cfx], ori_idx):
                                   break
                               if (cfx,ori_idx) in contacts_link_for_config:
                                   continue
-                              for f_pt in points_for_config2[cfx]:
-                                  vol_idx = vol_obj.getVolIndex(f_pt[1]-pos)
-                                  vol_sample = vol_obj.vol_samples[vol_idx[0]][vol_idx[1]][vol_idx[2]]
-                                  if not ori_idx in vol_sample:
+                              # entries of the volumetric map for the points of the config
+                              entry_idx = vol_obj.getEntryIndices(vol_lin_for_config[cfx], ori_idx)
+                              entry_found = entry_idx >= 0
+                              entry_normals = np.zeros((len(entry_idx), 3))
+                              entry_normals[entry_found] = vol_obj.entries_normal[entry_idx[entry_found]]
+                              entry_types = np.zeros(len(entry_idx), dtype=np.int64)
+                              entry_types[entry_found] = vol_obj.entries_type[entry_idx[entry_found]]
+                              entry_found = entry_found.tolist()
+                              entry_normals = entry_normals.tolist()
+                              entry_types = entry_types.tolist()
+                              for f_pt_idx in range(len(points_for_config2[cfx])):
+                                  if not entry_found[f_pt_idx]:
                                       continue
+                                  f_pt = points_for_config2[cfx][f_pt_idx]
+                                  vol_idx = vol_idx_for_config[cfx][f_pt_idx]
 
-                                  norm, type_surf = vol_sample[ori_idx]
-                                  normal_obj_E = TR_E_O * norm
+                                  norm = entry_normals[f_pt_idx]
+                                  type_surf = entry_types[f_pt_idx]
+                                  normal_obj_E = TR_E_O * PyKDL.Vector(norm[0], norm[1], norm[2])
                                   # check the contact between two surfaces
                                   if f_pt[3] == 0 and type_surf==0:
                                       if PyKDL.dot(normal_obj_E, f_pt[2]) < -0.8:
@@ -1208,7 +1352,7 @@ Class for grasp learning.
 #                                          normals_for_config[(cfx,ori_idx)].append(normal_obj_E)
 #                                      is_plane_obj_config[(cfx,ori_idx)] = type_surf==0
                                   else:
-                                      forbidden_cf_ori[cfx].add(ori_idx)
+                                      volumetricutils.setOrientationBit(forbidden_cf_ori[cfx], ori_idx)
                                       break
                               if not ori_ok:
                                   break
@@ -1227,7 +1371,7 @@ Class for grasp learning.
                               xi, yi, zi = voxel_grid.getPointIndex(pt_E)
                               if xi >= voxel_grid.grid_size[0] or xi < 0 or yi >= voxel_grid.grid_size[1] or yi < 0 or zi >= voxel_grid.grid_size[2] or zi < 0:
                                   continue
-                              for pt_gr in voxel_grid.grid[xi][yi][zi]:
+                              for pt_gr in voxel_grid.getVoxelPoints(xi, yi, zi):
                                   if pt_gr[4] == cf1 or pt_gr[4] == cf2 or pt_gr[4] == cf3:
                                       collision = True
                                       break
@@ -1672,7 +1816,7 @@ Class for grasp learning.
         vol_map_filename = "vol_map.txt"
         if False:
             print "generating volumetric map (%s iterations)..."%(len(vol_obj.orientations) * len(vol_obj.surface_points_obj))
-            vol_obj.generate()
+            vol_obj.generate(workers_count=3)
             print "done."
             vol_obj.save(vol_map_filename)
         else:
@@ -1861,6 +2005,7 @@ Class for grasp learning.
 
         print "done."
         gripper_model = GripperModel(self.openrave_robot, self.grasper)
+        gripper_model.loadLinkPoses("link_poses_40.npz")
 
         if False:
                 for fi in range(len(gripper_model.f1_configs)):
@@ -1908,14 +2053,13 @@ Class for grasp learning.
             # check self collisions of the gripper
             #
             self_collision_set_filename = "self_collision_40.txt"
-            self_collisions_configs = set()
+            self_collision_map_filename = "self_collision_40.bin"
             if False:
                 print "checking self collision for all configurations..."
-                self_collisions_configs = gripper_model.generateSelfCollisionData()
+                self_collisions_configs = gripper_model.generateSelfCollisionDataParallel('barrett_key.env.xml', "self_collision_40_shards", workers_count=4)
                 print "done."
                 self.saveSelfCollisionData(self_collision_set_filename, self_collisions_configs)
-            else:
-                self_collisions_configs = self.loadSelfCollisionData(self_collision_set_filename)
+            self_collisions_configs = volumetricutils.loadSelfCollisionMap(self_collision_set_filename, self_collision_map_filename, [len(dof_cf) for dof_cf in gripper_model.dof_configs])
 
 
             voxel_grid = volumetricutils.VoxelGrid(0.005)
@@ -2064,12 +2208,10 @@ Class for grasp learning.
                 d = - PyKDL.dot(n_E, (T_E_O * PyKDL.Vector(0.029,0,0)))
 
                 cf = grasp.hand_config
-                self.openrave_robot.SetDOFValues([gripper_model.sp_configs[cf[0]]/180.0*math.pi,gripper_model.f1_configs[cf[1]]/180.0*math.pi,gripper_model.f3_configs[cf[2]]/180.0*math.pi,gripper_model.f2_configs[cf[3]]/180.0*math.pi])
 
                 bad_grasp = False
                 for link_name in link_names:
-                    T_W_L = OpenraveToKDL(self.openrave_robot.GetLink(link_name).GetTransform())
-                    T_E_L = T_W_E.Inverse() * T_W_L
+                    T_E_L = OpenraveToKDL(gripper_model.getLinkPose(link_name, cf))
                     for pt in link_points[link_name]:
                         pt_L = pt.pos
                         pt_E = T_E_L * pt_L
@@ -2099,11 +2241,13 @@ Class for grasp learning.
                 grasp.id = grasp_idx
                 grasps_simplified.append( (grasp.obj_pos_E, vol_obj.orientations[grasp.obj_ori_idx], grasp.dof_directions, grasp.hand_config, grasp.id) )
             grasps_grid.build(grasps_simplified)
+            centers = np.array([[grasp_simp[0][0], grasp_simp[0][1], grasp_simp[0][2]] for grasp_simp in grasps_simplified])
+            close_offsets, close_ids = grasps_grid.getPointsAtPoints(centers, 0.0025)
 
             for grasp_idx in range(len(good_grasps)):
                 grasp_simp = grasps_simplified[grasp_idx]
                 grasp_cf = gripper_model.getAnglesForConfigIdx(grasp_simp[3])
-                close_grasps = grasps_grid.getPointsAtPoint(grasp_simp[0], 0.0025)
+                close_grasps = [grasps_simplified[i] for i in close_ids[close_offsets[grasp_idx]:close_offsets[grasp_idx+1]]]
                 errors = []
                 for close_gr in close_grasps:
                     if grasp_simp[2][0] * close_gr[2][0] < 0:
@@ -2329,13 +2473,15 @@ Class for grasp learning.
             for grasp in good_grasps:
                 grasps_simplified.append( (grasp.obj_pos_E, vol_obj.orientations[grasp.obj_ori_idx], grasp.dof_directions, grasp.hand_config) )
             grasps_grid.build(grasps_simplified)
+            centers = np.array([[grasp[0][0], grasp[0][1], grasp[0][2]] for grasp in grasps_simplified])
+            close_offsets, close_ids = grasps_grid.getPointsAtPoints(centers, 0.0025)
             good_grasps = None
             indices_ok = []
             errors_all = {}
             for grasp_idx in range(len(grasps_simplified)):
                 grasp = grasps_simplified[grasp_idx]
                 grasp_cf = gripper_model.getAnglesForConfigIdx(grasp[3])
-                close_grasps = grasps_grid.getPointsAtPoint(grasp[0], 0.0025)
+                close_grasps = [grasps_simplified[i] for i in close_ids[close_offsets[grasp_idx]:close_offsets[grasp_idx+1]]]
                 errors = []
                 for close_gr in close_grasps:
                     if grasp[2][0] * close_gr[2][0] < 0:
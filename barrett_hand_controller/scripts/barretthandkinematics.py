@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2014, Robot Control and Pattern Recognition Group, Warsaw University of Technology
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Warsaw University of Technology nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYright HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import numpy as np
+import math
+import sys
+import xml.etree.ElementTree as ET
+
+#
+# forward kinematics of the BarrettHand for batches of joint vectors in the
+# order of dofs of the hand in OpenRAVE (sp, f1, f3, f2); the spread moves
+# knuckle one of fingers one and two, knuckle three of every finger is
+# coupled with its knuckle two
+#
+
+# coupled joints: (actuated joint, multiplier), the same as the mimic
+# equations of the hand in OpenRAVE
+HAND_MIMIC_JOINTS = {
+"HandFingerTwoKnuckleOneJoint" : ("HandFingerOneKnuckleOneJoint", 1.0),
+"HandFingerOneKnuckleThreeJoint" : ("HandFingerOneKnuckleTwoJoint", 0.33333),
+"HandFingerTwoKnuckleThreeJoint" : ("HandFingerTwoKnuckleTwoJoint", 0.33333),
+"HandFingerThreeKnuckleThreeJoint" : ("HandFingerThreeKnuckleTwoJoint", 0.33333),
+}
+
+HAND_ROOT_LINK = "HandPalmLink"
+
+def getRpyRotation(r, p, y):
+    # URDF convention: R = Rz(y) * Ry(p) * Rx(r)
+    cr, sr = math.cos(r), math.sin(r)
+    cp, sp = math.cos(p), math.sin(p)
+    cy, sy = math.cos(y), math.sin(y)
+    return np.array([
+    [cy*cp, cy*sp*sr - sy*cr, cy*sp*cr + sy*sr],
+    [sy*cp, sy*sp*sr + cy*cr, sy*sp*cr - cy*sr],
+    [-sp, cp*sr, cp*cr]])
+
+def getAxisRotations(axis, angles):
+    # (N,4,4) transforms of rotations by angles about the axis
+    k = np.asarray(axis, dtype=np.float64) / np.linalg.norm(axis)
+    K = np.array([[0.0, -k[2], k[1]], [k[2], 0.0, -k[0]], [-k[1], k[0], 0.0]])
+    c = np.cos(angles).reshape(-1, 1, 1)
+    s = np.sin(angles).reshape(-1, 1, 1)
+    T = np.zeros((len(c), 4, 4))
+    T[:,:3,:3] = c * np.identity(3) + s * K + (1.0 - c) * np.outer(k, k)
+    T[:,3,3] = 1.0
+    return T
+
+class BarrettHandJoint:
+    def __init__(self, name, parent, child, origin, axis, dof, multiplier, anchor=None):
+        self.name = name
+        self.parent = parent
+        self.child = child
+        # transform of the child link for zero joint value
+        self.origin = origin
+        # axis in the child link frame, None for fixed joints
+        self.axis = axis
+        # point on the axis in the child link frame
+        if anchor is None:
+            anchor = np.zeros(3)
+        self.anchor = np.asarray(anchor, dtype=np.float64)
+        self.dof = dof
+        self.multiplier = multiplier
+
+class BarrettHandKinematics:
+    def __init__(self, joints, prefix):
+        self.prefix = prefix
+        self.root_link = prefix + "_" + HAND_ROOT_LINK
+        # joints in the order of the kinematic tree, starting from the palm
+        self.joints = []
+        links = set([self.root_link])
+        remaining = list(joints)
+        while len(remaining) > 0:
+            next_joints = [j for j in remaining if j.parent in links]
+            if len(next_joints) == 0:
+                break
+            for j in next_joints:
+                self.joints.append(j)
+                links.add(j.child)
+            remaining = [j for j in remaining if not j in next_joints]
+        self.link_names = [self.root_link] + [j.child for j in self.joints]
+
+    def getLinkFrames(self, q):
+        # dict {link name: (N,4,4) palm-relative transforms} for the (N,4)
+        # array of joint vectors in the order of dofs of OpenRAVE, joint limits
+        # are not applied
+        q = np.asarray(q, dtype=np.float64).reshape(-1, 4)
+        frames = {}
+        frames[self.root_link] = np.tile(np.identity(4), (len(q), 1, 1))
+        for j in self.joints:
+            T_P_C = np.matmul(frames[j.parent], j.origin)
+            if j.axis is None:
+                frames[j.child] = T_P_C
+            else:
+                # rotation about the axis passing through the anchor
+                T_C = getAxisRotations(j.axis, q[:,j.dof] * j.multiplier)
+                T_C[:,:3,3] = j.anchor - np.dot(T_C[:,:3,:3], j.anchor)
+                frames[j.child] = np.matmul(T_P_C, T_C)
+        return frames
+
+    def getLinkFramesArray(self, q, link_names):
+        # (N,L,4,4) array of palm-relative transforms of the links
+        frames = self.getLinkFrames(q)
+        return np.stack([frames[link_name] for link_name in link_names], axis=1)
+
+def getOpenraveDofJoints(openrave_robot):
+    # names of the actuated joints of the robot in the order of its dofs
+    dof_joints = [None] * openrave_robot.GetDOF()
+    for joint in openrave_robot.GetJoints():
+        if joint.GetDOFIndex() >= 0:
+            dof_joints[joint.GetDOFIndex()] = joint.GetName()
+    return dof_joints
+
+def getHandJointDof(name, dof_joints, prefix, mimic=None):
+    # (dof, multiplier) of the hand joint, None for the joints that do not
+    # belong to the hand dofs
+    short_name = name[len(prefix)+1:] if name.startswith(prefix + "_") else name
+    if mimic == None and short_name in HAND_MIMIC_JOINTS:
+        mimic = (prefix + "_" + HAND_MIMIC_JOINTS[short_name][0], HAND_MIMIC_JOINTS[short_name][1])
+    if mimic != None:
+        dof, multiplier = getHandJointDof(mimic[0], dof_joints, prefix)
+        if dof == None:
+            return None, None
+        return dof, multiplier * mimic[1]
+    if name in dof_joints:
+        return dof_joints.index(name), 1.0
+    return None, None
+
+def loadUrdf(filename, dof_joints, prefix="right"):
+    # kinematics of the hand from the URDF file (processed by xacro) or the
+    # file object; dof_joints are the names of the actuated joints in the
+    # order of dofs, e.g. from getOpenraveDofJoints
+    robot = ET.parse(filename).getroot()
+    joints = []
+    for joint in robot.findall('joint'):
+        name = joint.get('name')
+        joint_type = joint.get('type')
+        origin_xyz = [0.0, 0.0, 0.0]
+        origin_rpy = [0.0, 0.0, 0.0]
+        origin = joint.find('origin')
+        if origin != None:
+            if origin.get('xyz') != None:
+                origin_xyz = [float(x) for x in origin.get('xyz').split()]
+            if origin.get('rpy') != None:
+                origin_rpy = [float(x) for x in origin.get('rpy').split()]
+        T = np.identity(4)
+        T[:3,:3] = getRpyRotation(origin_rpy[0], origin_rpy[1], origin_rpy[2])
+        T[:3,3] = origin_xyz
+        if joint_type == 'fixed':
+            axis, dof, multiplier = None, None, None
+        elif joint_type in ('revolute', 'continuous'):
+            axis = [1.0, 0.0, 0.0]
+            if joint.find('axis') != None:
+                axis = [float(x) for x in joint.find('axis').get('xyz').split()]
+            mimic = joint.find('mimic')
+            if mimic != None:
+                mimic = (mimic.get('joint'), float(mimic.get('multiplier', 1.0)))
+            dof, multiplier = getHandJointDof(name, dof_joints, prefix, mimic)
+            if dof == None:
+                continue
+        else:
+            continue
+        joints.append( BarrettHandJoint(name, joint.find('parent').get('link'), joint.find('child').get('link'), T, axis, dof, multiplier) )
+    return BarrettHandKinematics(joints, prefix)
+
+def getOpenraveKinematics(openrave_robot, prefix="right"):
+    # kinematics of the hand from the robot loaded in OpenRAVE; the link
+    # transforms and the joint anchors are read for zero joint values
+    dof_values = openrave_robot.GetDOFValues()
+    openrave_robot.SetDOFValues(np.zeros(openrave_robot.GetDOF()), range(openrave_robot.GetDOF()), checklimits=False)
+    dof_joints = getOpenraveDofJoints(openrave_robot)
+    joints = []
+    for joint in list(openrave_robot.GetJoints()) + list(openrave_robot.GetPassiveJoints()):
+        parent = joint.GetHierarchyParentLink()
+        child = joint.GetHierarchyChildLink()
+        if parent == None or child == None:
+            continue
+        T_W_P = parent.GetTransform()
+        T_W_C = child.GetTransform()
+        if joint.IsStatic():
+            axis, dof, multiplier, anchor = None, None, None, None
+        else:
+            axis = np.dot(T_W_C[:3,:3].T, joint.GetAxis(0))
+            anchor = np.dot(np.linalg.inv(T_W_C), np.append(joint.GetAnchor(), 1.0))[:3]
+            dof, multiplier = getHandJointDof(joint.GetName(), dof_joints, prefix)
+            if dof == None:
+                continue
+        joints.append( BarrettHandJoint(joint.GetName(), parent.GetName(), child.GetName(), np.dot(np.linalg.inv(T_W_P), T_W_C), axis, dof, multiplier, anchor) )
+    openrave_robot.SetDOFValues(dof_values)
+    return BarrettHandKinematics(joints, prefix)
+
+def getOpenraveLinkFrames(openrave_robot, q, link_names, root_link):
+    # (N,L,4,4) transforms of the links relative to root_link computed by
+    # OpenRAVE, used for validation
+    dof_values = openrave_robot.GetDOFValues()
+    q = np.asarray(q, dtype=np.float64).reshape(-1, 4)
+    frames = np.zeros((len(q), len(link_names), 4, 4))
+    for i in range(len(q)):
+        openrave_robot.SetDOFValues(q[i], [0,1,2,3], checklimits=False)
+        T_E_W = np.linalg.inv(openrave_robot.GetLink(root_link).GetTransform())
+        for link_idx in range(len(link_names)):
+            frames[i, link_idx] = np.dot(T_E_W, openrave_robot.GetLink(link_names[link_idx]).GetTransform())
+    openrave_robot.SetDOFValues(dof_values)
+    return frames
+
+def getFramesError(frames1, frames2):
+    # max position error and max rotation error (the angle) of the arrays of
+    # transforms
+    pos_error = np.max(np.linalg.norm(frames1[...,:3,3] - frames2[...,:3,3], axis=-1))
+    R = np.matmul(np.swapaxes(frames1[...,:3,:3], -1, -2), frames2[...,:3,:3])
+    cos_angle = (np.trace(R, axis1=-2, axis2=-1) - 1.0) / 2.0
+    rot_error = np.max(np.arccos(np.clip(cos_angle, -1.0, 1.0)))
+    return pos_error, rot_error
+
+def testKinematics(openrave_robot, urdf_filename, prefix="right", samples_count=1000, tolerance=1.0e-6):
+    # compares the link frames for random joint vectors with OpenRAVE, for the
+    # kinematics read from the URDF file and from OpenRAVE
+    lower, upper = openrave_robot.GetDOFLimits()
+    q = np.random.uniform(lower[:4], upper[:4], (samples_count, 4))
+    errors = []
+    for source, kinematics in (("urdf", loadUrdf(urdf_filename, getOpenraveDofJoints(openrave_robot), prefix)), ("openrave", getOpenraveKinematics(openrave_robot, prefix))):
+        frames = kinematics.getLinkFramesArray(q, kinematics.link_names)
+        frames_openrave = getOpenraveLinkFrames(openrave_robot, q, kinematics.link_names, kinematics.root_link)
+        pos_error, rot_error = getFramesError(frames, frames_openrave)
+        print "testKinematics: %s: %s links, %s samples, max position error: %s, max rotation error: %s"%(source, len(kinematics.link_names), samples_count, pos_error, rot_error)
+        if len(kinematics.joints) == 0 or pos_error > tolerance or rot_error > tolerance:
+            errors.append(source)
+    if len(errors) > 0:
+        raise Exception("testKinematics: the kinematics of the hand from %s does not match OpenRAVE"%(", ".join(errors)))
+
+if __name__ == "__main__":
+    # usage: barretthandkinematics.py urdf_file [env_file]
+    from openravepy import Environment
+    env = Environment()
+    env.Load(sys.argv[2] if len(sys.argv) > 2 else 'barrett_key.env.xml')
+    testKinematics(env.GetRobots()[0], sys.argv[1])
+    env.Destroy()
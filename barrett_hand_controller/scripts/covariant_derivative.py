@@ -41,6 +41,7 @@ import numpy as np
 import copy
 import random
 import velmautils
+import surfaceutils
 from subprocess import call
 import operator
 
@@ -59,7 +60,7 @@ Class for medial axis computation test.
         dimy = 0.1
         dimz = 0.1
 
-        vertices, faces = velmautils.readMesh('cube.mesh')
+        vertices, faces = surfaceutils.readMesh('cube.mesh')
 
         vx = []
         for v in vertices:
@@ -953,7 +953,8 @@ Class for grasp learning.
             #
             print "sampling the surface of the object..."
             vertices_obj, faces_obj = surfaceutils.readStl("klucz_gerda_ascii.stl", scale=1.0)
-            surface_points_obj = surfaceutils.sampleMeshDetailedRays(vertices_obj, faces_obj, 0.0015)
+            cloud_obj = surfaceutils.sampleMeshCached(vertices_obj, faces_obj, 0.0015, curvature_radius=0.003)
+            surface_points_obj = cloud_obj.toSurfacePoints()
             print "surface of the object has %s points"%(len(surface_points_obj))
 
             # disallow contact with the surface points beyond the key handle
@@ -1024,33 +1025,11 @@ Class for grasp learning.
 
             print "subset size: %s"%(len(sampled_points2_obj))
 
-            print "calculating surface curvature at sampled points of the obj..."
             m_id = 0
-            planes = 0
-            edges = 0
-            points = 0
-            for pt_idx in range(len(surface_points_obj)):#sampled_points_obj
-                indices, nx, pc1, pc2 = surfaceutils.pclPrincipalCurvaturesEstimation(surface_points_obj, pt_idx, 5, 0.003)
-#                m_id = self.pub_marker.publishVectorMarker(self.T_W_O * surface_points_obj[pt_idx].pos, self.T_W_O * (surface_points_obj[pt_idx].pos + nx*0.004), m_id, 1, 0, 0, frame='world', namespace='default', scale=0.0002)
-#                m_id = self.pub_marker.publishVectorMarker(self.T_W_O * surface_points_obj[pt_idx].pos, self.T_W_O * (surface_points_obj[pt_idx].pos + surface_points_obj[pt_idx].normal*0.004), m_id, 0, 0, 1, frame='world', namespace='default', scale=0.0002)
-                surface_points_obj[pt_idx].frame = PyKDL.Frame(PyKDL.Rotation(nx, surface_points_obj[pt_idx].normal * nx, surface_points_obj[pt_idx].normal), surface_points_obj[pt_idx].pos)
-                surface_points_obj[pt_idx].pc1 = pc1
-                surface_points_obj[pt_idx].pc2 = pc2
-                if pc1 < 0.2:
-                    surface_points_obj[pt_idx].is_plane = True
-                    surface_points_obj[pt_idx].is_edge = False
-                    surface_points_obj[pt_idx].is_point = False
-                    planes += 1
-                elif pc2 < 0.2:
-                    surface_points_obj[pt_idx].is_plane = False
-                    surface_points_obj[pt_idx].is_edge = True
-                    surface_points_obj[pt_idx].is_point = False
-                    edges += 1
-                else:
-                    surface_points_obj[pt_idx].is_plane = False
-                    surface_points_obj[pt_idx].is_edge = False
-                    surface_points_obj[pt_idx].is_point = True
-                    points += 1
+            labels = cloud_obj.surface_type
+            planes = np.sum(labels == 0)
+            edges = np.sum(labels == 1)
+            points = np.sum(labels == 2)
 
             print "obj planes: %s  edges: %s  points: %s"%(planes, edges, points)
 
@@ -1289,7 +1268,7 @@ Class for grasp learning.
             faces = col.indices
 
             print "sampling the surface..."
-            surface_points = surfaceutils.sampleMeshDetailedRays(vertices, faces, 0.0015)
+            surface_points = surfaceutils.sampleMeshCached(vertices, faces, 0.0015, curvature_radius=0.003).toSurfacePoints()
             print "surface has %s points"%(len(surface_points))
 
             surface_points_init = []
@@ -1316,29 +1295,6 @@ Class for grasp learning.
             print "subset size: %s"%(len(sampled_points))
 
 
-            for pt_idx in sampled_points:
-                indices, nx, pc1, pc2 = surfaceutils.pclPrincipalCurvaturesEstimation(surface_points, pt_idx, 5, 0.003)
-#                m_id = self.pub_marker.publishVectorMarker(self.T_W_O * surface_points[pt_idx].pos, self.T_W_O * (surface_points[pt_idx].pos + nx*0.004), m_id, 1, 0, 0, frame='world', namespace='default', scale=0.0002)
-#                m_id = self.pub_marker.publishVectorMarker(self.T_W_O * surface_points[pt_idx].pos, self.T_W_O * (surface_points[pt_idx].pos + surface_points[pt_idx].normal*0.004), m_id, 0, 0, 1, frame='world', namespace='default', scale=0.0002)
-
-                surface_points[pt_idx].frame = PyKDL.Frame(PyKDL.Rotation(nx, surface_points[pt_idx].normal * nx, surface_points[pt_idx].normal), surface_points[pt_idx].pos)
-                surface_points[pt_idx].pc1 = pc1
-                surface_points[pt_idx].pc2 = pc2
-                if pc1 < 0.2:
-                    surface_points[pt_idx].is_plane = True
-                    surface_points[pt_idx].is_edge = False
-                    surface_points[pt_idx].is_point = False
-                elif pc2 < 0.2:
-                    surface_points[pt_idx].is_plane = False
-                    surface_points[pt_idx].is_edge = True
-                    surface_points[pt_idx].is_point = False
-                else:
-                    surface_points[pt_idx].is_plane = False
-                    surface_points[pt_idx].is_edge = False
-                    surface_points[pt_idx].is_point = True
-
-
-
             interior_filename = "link_interior_points.txt"
 
             print "generating a set of interior points..."
@@ -2879,7 +2835,7 @@ Class for grasp learning.
 
             if False:
                 # ICR computation
-                surface_points = surfaceutils.sampleMeshDetailedRays(vertices, faces, 0.001)
+                surface_points = surfaceutils.sampleMeshCached(vertices, faces, 0.001).toSurfacePoints()
 
                 # disallow contact with the surface points beyond the key handle
                 for p in surface_points:
@@ -32,6 +32,11 @@ import numpy as np
 import copy
 import scipy
 import operator
+import itertools
+import os
+import hashlib
+import tempfile
+import time
 import rospy
 from geometry_msgs.msg import *
 from visualization_msgs.msg import *
@@ -59,67 +64,100 @@ def pointInTriangle(A, B, C, P):
     # Check if point is in triangle
     return (u >= 0) and (v >= 0) and (u + v < 1)
 
-def readMesh(filename):
+def getAngle(v1, v2):
+    return math.atan2((v1*v2).Norm(), PyKDL.dot(v1,v2))
+
+def readMeshText(filename):
     with open(filename, 'r') as f:
         header = f.readline()
         header_s = header.split()
         vert_count = int(header_s[0])
         face_count = int(header_s[1])
-        vertices = []
-        faces = []
-        for i in range(vert_count):
-            line = f.readline()
-            line_s = line.split()
-            vertices.append([float(line_s[0]),float(line_s[1]),float(line_s[2])])
-        for i in range(face_count):
-            line = f.readline()
-            line_s = line.split()
-            faces.append([int(line_s[0]),int(line_s[1]),int(line_s[2])])
+        body = f.read()
+
+    # fast path: three values in each line
+    values = np.fromstring(body, sep=' ')
+    if len(values) == 3 * (vert_count + face_count):
+        vertices = values[:3*vert_count].reshape(vert_count, 3)
+        faces = values[3*vert_count:].astype(np.int32).reshape(face_count, 3)
+        return vertices, faces
+
+    lines = body.splitlines()
+    vertices = np.array([line.split()[0:3] for line in lines[:vert_count]], dtype=np.float64).reshape(-1, 3)
+    faces = np.array([line.split()[0:3] for line in lines[vert_count:vert_count+face_count]], dtype=np.int32).reshape(-1, 3)
     return vertices, faces
 
-def readStl(filename, scale = 1.0):
-    line_no = 0
-    vertices_s = []
-    faces = []
-    with open(filename, 'r') as f:
-        header = f.readline()
-        line_no += 1
-        eof = False
-        while True:
-            lines = []
-            for i in range(7):
-                line = f.readline()
-                if line == None or line == '':
-                    eof = True
-                    break
-                lines.append(line)
-            if eof:
-                break
+# binary sidecar file: 8 bytes of magic, vertices and faces count (uint32),
+# vertices (float64) and faces (int32)
+MESH_BINARY_MAGIC = 'BHMESH01'
+
+def getMeshBinaryFilename(filename):
+    return filename + '.bin'
+
+def convertMeshToBinary(filename, binary_filename=None):
+    if binary_filename == None:
+        binary_filename = getMeshBinaryFilename(filename)
+    vertices, faces = readMeshText(filename)
+    with open(binary_filename, 'wb') as f:
+        f.write(MESH_BINARY_MAGIC)
+        f.write(np.array([len(vertices), len(faces)], dtype='<u4').tostring())
+        f.write(np.ascontiguousarray(vertices, dtype='<f8').tostring())
+        f.write(np.ascontiguousarray(faces, dtype='<i4').tostring())
+    return binary_filename
+
+def readMeshBinary(binary_filename):
+    header_size = len(MESH_BINARY_MAGIC) + 8
+    with open(binary_filename, 'rb') as f:
+        header = f.read(header_size)
+    if len(header) != header_size or header[:len(MESH_BINARY_MAGIC)] != MESH_BINARY_MAGIC:
+        raise ValueError("readMeshBinary: wrong header of file %s"%(binary_filename))
+    vert_count, face_count = np.frombuffer(header, dtype='<u4', count=2, offset=len(MESH_BINARY_MAGIC))
+    vertices = np.memmap(binary_filename, dtype='<f8', mode='r', offset=header_size, shape=(int(vert_count), 3))
+    faces = np.memmap(binary_filename, dtype='<i4', mode='r', offset=header_size + 24*int(vert_count), shape=(int(face_count), 3))
+    return vertices, faces
+
+def readMesh(filename, create_binary=False):
+    # returns (V,3) float64 and (F,3) int32 arrays; if there is an up to date
+    # binary sidecar file (see convertMeshToBinary), it is memory-mapped
+    binary_filename = getMeshBinaryFilename(filename)
+    if os.path.isfile(binary_filename) and os.path.getmtime(binary_filename) >= os.path.getmtime(filename):
+        try:
+            return readMeshBinary(binary_filename)
+        except ValueError as e:
+            print e
+    if create_binary:
+        convertMeshToBinary(filename, binary_filename)
+        return readMeshBinary(binary_filename)
+    return readMeshText(filename)
+
+def weldVertices(corners, weld_eps = 1e-6):
+    # corners is a (F*3,3) array of triangle corners; identical (up to weld_eps)
+    # corners are merged using hashed keys of the quantized coordinates
+    corners = np.asarray(corners, dtype=np.float64).reshape(-1, 3)
+    keys = np.ascontiguousarray(np.round(corners / weld_eps).astype(np.int64))
+    keys = keys.view(np.dtype((np.void, keys.dtype.itemsize * 3))).ravel()
+    unique_keys, first_idx, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    # keep the order of the first occurence of each vertex
+    order = np.argsort(first_idx)
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order), dtype=np.int32)
+    vertices = corners[first_idx[order]]
+    faces = rank[inverse].reshape(-1, 3)
+    return vertices, faces
 
-            vertex = []
-            vertex.append(lines[2].split())
-            vertex.append(lines[3].split())
-            vertex.append(lines[4].split())
-            face = []
-            for i in range(3):
-                if vertex[i][0] != 'vertex':
-                    print "readStl: error on line %s"%(line_no+2+i)
-                found_vertex = False
-                for v_id in range(len(vertices_s)):
-                    if vertices_s[v_id][0] == vertex[i][1] and vertices_s[v_id][1] == vertex[i][2] and vertices_s[v_id][2] == vertex[i][3]:
-                        found_vertex = True
-                        break
-                if not found_vertex:
-                    vertices_s.append([vertex[i][1], vertex[i][2], vertex[i][3]])
-                    v_id = len(vertices_s) - 1
-                face.append(v_id)
-            faces.append(face)
-            line_no += 7
-
-    vertices = []
-    for v_s in vertices_s:
-        vertices.append([scale*float(v_s[0]), scale*float(v_s[1]), scale*float(v_s[2])])
+def isBinaryStl(data):
+    if len(data) < 84:
+        return False
+    facets_count = np.frombuffer(data, dtype='<u4', count=1, offset=80)[0]
+    return 84 + 50 * int(facets_count) == len(data)
 
+def readStlBinaryCorners(data):
+    facets_count = int(np.frombuffer(data, dtype='<u4', count=1, offset=80)[0])
+    facet_dtype = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3,3)), ('attr', '<u2')])
+    facets = np.frombuffer(data, dtype=facet_dtype, count=facets_count, offset=84)
+    return facets['vertices'].reshape(-1, 3).astype(np.float64)
+
+def readStlAsciiCorners(data):
 #facet normal -0.514031 0.017857 -0.857586
 #outer loop
 #vertex -26.348042 5.528012 -2.000000
@@ -127,8 +165,30 @@ def readStl(filename, scale = 1.0):
 #vertex -28.000000 6.000000 -1.000000
 #endloop
 #endfacet
-
-    return vertices, faces
+    tokens = np.array(data.split())
+    vertex_idx = np.nonzero(tokens == 'vertex')[0]
+    if len(vertex_idx) % 3 != 0:
+        print "readStl: error: number of vertices (%s) is not a multiple of 3"%(len(vertex_idx))
+        vertex_idx = vertex_idx[:len(vertex_idx) - len(vertex_idx) % 3]
+    coord_idx = (vertex_idx.reshape(-1, 1) + np.arange(1, 4)).ravel()
+    return tokens[coord_idx].astype(np.float64).reshape(-1, 3)
+
+def readStl(filename, scale = 1.0, weld_eps = 1e-6):
+    # reads both ascii and binary STL files; vertices shared by many facets
+    # are welded, so the result is a (V,3) float64 array and a (F,3) int32 array
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    if isBinaryStl(data):
+        corners = readStlBinaryCorners(data)
+    else:
+        corners = readStlAsciiCorners(data)
+
+    if len(corners) == 0:
+        return np.zeros((0,3)), np.zeros((0,3), dtype=np.int32)
+
+    vertices, faces = weldVertices(corners, weld_eps)
+    return vertices * scale, faces
 
 class SurfacePoint:
 
@@ -147,6 +207,212 @@ class SurfacePoint:
         self.allowed = True
         self.contact_regions = None
 
+class SurfacePointView(object):
+    # thin view of a single point of SurfacePointCloud with the interface of
+    # SurfacePoint, for the code that works on lists of surface points
+
+    def __init__(self, cloud, idx):
+        self.cloud = cloud
+        self.id = idx
+
+    @property
+    def pos(self):
+        p = self.cloud.positions[self.id]
+        return PyKDL.Vector(p[0], p[1], p[2])
+
+    @property
+    def normal(self):
+        n = self.cloud.normals[self.id]
+        return PyKDL.Vector(float(n[0]), float(n[1]), float(n[2]))
+
+    @property
+    def frame(self):
+        if self.cloud.surface_type[self.id] == SurfacePointCloud.TYPE_UNKNOWN:
+            return None
+        d = self.cloud.directions[self.id]
+        nx = PyKDL.Vector(float(d[0]), float(d[1]), float(d[2]))
+        normal = self.normal
+        return PyKDL.Frame(PyKDL.Rotation(nx, normal * nx, normal), self.pos)
+
+    @property
+    def pc1(self):
+        if self.cloud.surface_type[self.id] == SurfacePointCloud.TYPE_UNKNOWN:
+            return None
+        return float(self.cloud.pc1[self.id])
+
+    @property
+    def pc2(self):
+        if self.cloud.surface_type[self.id] == SurfacePointCloud.TYPE_UNKNOWN:
+            return None
+        return float(self.cloud.pc2[self.id])
+
+    @property
+    def is_plane(self):
+        return self.cloud.getSurfaceTypeFlag(self.id, SurfacePointCloud.TYPE_PLANE)
+
+    @property
+    def is_edge(self):
+        return self.cloud.getSurfaceTypeFlag(self.id, SurfacePointCloud.TYPE_EDGE)
+
+    @property
+    def is_point(self):
+        return self.cloud.getSurfaceTypeFlag(self.id, SurfacePointCloud.TYPE_POINT)
+
+    @property
+    def neighbors_id(self):
+        return self.cloud.getNeighbors(self.id).tolist()
+
+    @property
+    def visited(self):
+        return bool(self.cloud.visited[self.id])
+
+    @visited.setter
+    def visited(self, value):
+        self.cloud.visited[self.id] = value
+
+    @property
+    def allowed(self):
+        return bool(self.cloud.allowed[self.id])
+
+    @allowed.setter
+    def allowed(self, value):
+        self.cloud.allowed[self.id] = value
+
+    @property
+    def contact_regions(self):
+        return self.cloud.contact_regions.get(self.id, None)
+
+    @contact_regions.setter
+    def contact_regions(self, value):
+        self.cloud.contact_regions[self.id] = value
+
+class SurfacePointCloud(object):
+    # struct-of-arrays storage of surface points: positions, normals,
+    # curvature, surface type and flags are kept in numpy arrays and the
+    # neighbors graph in the CSR format (neighbors_offsets, neighbors_ids);
+    # cloud[idx] returns a SurfacePointView that behaves like SurfacePoint
+
+    TYPE_PLANE = 0
+    TYPE_EDGE = 1
+    TYPE_POINT = 2
+    TYPE_UNKNOWN = 255
+
+    def __init__(self, positions, normals, neighbors_offsets=None, neighbors_ids=None):
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        self.normals = np.asarray(normals, dtype=np.float32).reshape(-1, 3)
+        points_count = len(self.positions)
+        if len(self.normals) != points_count:
+            raise ValueError("SurfacePointCloud: positions and normals have different sizes: %s, %s"%(points_count, len(self.normals)))
+        self.pc1 = np.zeros(points_count, dtype=np.float32)
+        self.pc2 = np.zeros(points_count, dtype=np.float32)
+        self.directions = np.zeros((points_count, 3), dtype=np.float32)
+        self.surface_type = np.empty(points_count, dtype=np.uint8)
+        self.surface_type.fill(SurfacePointCloud.TYPE_UNKNOWN)
+        self.allowed = np.ones(points_count, dtype=bool)
+        self.visited = np.zeros(points_count, dtype=bool)
+        self.contact_regions = {}
+        if neighbors_offsets is None:
+            self.neighbors_offsets = np.zeros(points_count + 1, dtype=np.int32)
+            self.neighbors_ids = np.zeros(0, dtype=np.int32)
+        else:
+            self.neighbors_offsets = np.asarray(neighbors_offsets, dtype=np.int32)
+            self.neighbors_ids = np.asarray(neighbors_ids, dtype=np.int32)
+
+    @staticmethod
+    def fromSurfacePoints(surf_points):
+        positions = np.array([[pt.pos[0], pt.pos[1], pt.pos[2]] for pt in surf_points]).reshape(-1, 3)
+        normals = np.array([[pt.normal[0], pt.normal[1], pt.normal[2]] for pt in surf_points]).reshape(-1, 3)
+        neighbors_count = np.array([len(pt.neighbors_id) for pt in surf_points], dtype=np.int32)
+        neighbors_offsets = np.zeros(len(surf_points) + 1, dtype=np.int32)
+        neighbors_offsets[1:] = np.cumsum(neighbors_count)
+        neighbors_ids = np.array([n_id for pt in surf_points for n_id in pt.neighbors_id], dtype=np.int32)
+        cloud = SurfacePointCloud(positions, normals, neighbors_offsets, neighbors_ids)
+        for pt_idx in range(len(surf_points)):
+            pt = surf_points[pt_idx]
+            cloud.allowed[pt_idx] = pt.allowed
+            if pt.contact_regions != None:
+                cloud.contact_regions[pt_idx] = pt.contact_regions
+            if pt.pc1 == None:
+                continue
+            cloud.pc1[pt_idx] = pt.pc1
+            cloud.pc2[pt_idx] = pt.pc2
+            if pt.frame != None:
+                cloud.directions[pt_idx] = [pt.frame.M[0,0], pt.frame.M[1,0], pt.frame.M[2,0]]
+            if pt.is_plane:
+                cloud.surface_type[pt_idx] = SurfacePointCloud.TYPE_PLANE
+            elif pt.is_edge:
+                cloud.surface_type[pt_idx] = SurfacePointCloud.TYPE_EDGE
+            elif pt.is_point:
+                cloud.surface_type[pt_idx] = SurfacePointCloud.TYPE_POINT
+        return cloud
+
+    def toSurfacePoints(self):
+        surf_points = []
+        for pt_idx in range(len(self)):
+            view = self[pt_idx]
+            pt = SurfacePoint()
+            pt.id = pt_idx
+            pt.pos = view.pos
+            pt.normal = view.normal
+            pt.frame = view.frame
+            pt.pc1 = view.pc1
+            pt.pc2 = view.pc2
+            pt.is_plane = view.is_plane
+            pt.is_edge = view.is_edge
+            pt.is_point = view.is_point
+            pt.neighbors_id = view.neighbors_id
+            pt.allowed = view.allowed
+            pt.contact_regions = view.contact_regions
+            surf_points.append(pt)
+        return surf_points
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("SurfacePointCloud: index out of range: %s"%(idx))
+        return SurfacePointView(self, idx)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield SurfacePointView(self, idx)
+
+    def getNeighbors(self, idx):
+        return self.neighbors_ids[self.neighbors_offsets[idx]:self.neighbors_offsets[idx+1]]
+
+    def setRadiusNeighbors(self, radius):
+        neighbors_offsets, neighbors_ids = getRadiusNeighbors(self.positions, radius)
+        self.neighbors_offsets = neighbors_offsets.astype(np.int32)
+        self.neighbors_ids = neighbors_ids.astype(np.int32)
+
+    def getSurfaceTypeFlag(self, idx, surface_type):
+        if self.surface_type[idx] == SurfacePointCloud.TYPE_UNKNOWN:
+            return None
+        return bool(self.surface_type[idx] == surface_type)
+
+    def computeCurvatures(self, radius):
+        pc1, pc2, directions, labels = computePrincipalCurvatures(self.positions, self.normals, radius)
+        self.pc1 = pc1.astype(np.float32)
+        self.pc2 = pc2.astype(np.float32)
+        self.directions = directions.astype(np.float32)
+        self.surface_type = labels
+        return labels
+
+    def getClosestPoint(self, pos):
+        diff = self.positions - np.array([pos[0], pos[1], pos[2]])
+        return int(np.argmin(np.sum(diff * diff, axis=1)))
+
+    def resetVisited(self):
+        self.visited.fill(False)
+
+    def memoryUsage(self):
+        arrays = [self.positions, self.normals, self.pc1, self.pc2, self.directions, self.surface_type,
+            self.allowed, self.visited, self.neighbors_offsets, self.neighbors_ids]
+        return sum([a.nbytes for a in arrays])
+
 # this code is taken from PCL (https://github.com/PointCloudLibrary/pcl/blob/pcl-1.7.2/features/include/pcl/features/impl/principal_curvatures.hpp)
 def pclPrincipalCurvaturesEstimation(surf_points, p_idx, neighborhood, neighborhood_dist):
 
@@ -247,6 +513,216 @@ def pclPrincipalCurvaturesEstimation(surf_points, p_idx, neighborhood, neighborh
 
     return indices, pc, pc1, pc2
 
+def expandRanges(starts, counts):
+    # concatenation of ranges [starts[i], starts[i]+counts[i]) as one array
+    starts = np.asarray(starts, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    total = int(np.sum(counts))
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    range_begin = np.cumsum(counts) - counts
+    return np.arange(total, dtype=np.int64) - np.repeat(range_begin - starts, counts)
+
+def queryRadiusNeighbors(positions, queries, radius, inclusive=False, return_dist=False):
+    # for every query point finds the positions closer than radius (or not
+    # farther than radius, if inclusive) using a uniform hash grid with
+    # the cell size equal to radius; the result is in the CSR format:
+    # neighbors of the query i are
+    # neighbors_ids[neighbors_offsets[i]:neighbors_offsets[i+1]], sorted by id;
+    # squared distances (in the same order) are returned if return_dist is set
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    queries = np.asarray(queries, dtype=np.float64).reshape(-1, 3)
+    queries_count = len(queries)
+    if len(positions) == 0 or queries_count == 0:
+        neighbors_offsets = np.zeros(queries_count + 1, dtype=np.int64)
+        if return_dist:
+            return neighbors_offsets, np.zeros(0, dtype=np.int64), np.zeros(0)
+        return neighbors_offsets, np.zeros(0, dtype=np.int64)
+
+    dim_min = np.min(positions, axis=0)
+    cells = np.floor((positions - dim_min) / radius).astype(np.int64)
+    grid_size = np.max(cells, axis=0) + 1
+    keys = (cells[:,0] * grid_size[1] + cells[:,1]) * grid_size[2] + cells[:,2]
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    cells_q = np.floor((queries - dim_min) / radius).astype(np.int64)
+
+    pairs_i = []
+    pairs_j = []
+    pairs_dist2 = []
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+        cells_n = cells_q + np.array(offset, dtype=np.int64)
+        valid = np.all((cells_n >= 0) & (cells_n < grid_size), axis=1)
+        q_ids = np.nonzero(valid)[0]
+        cells_n = cells_n[q_ids]
+        keys_n = (cells_n[:,0] * grid_size[1] + cells_n[:,1]) * grid_size[2] + cells_n[:,2]
+        starts = np.searchsorted(sorted_keys, keys_n, side='left')
+        counts = np.searchsorted(sorted_keys, keys_n, side='right') - starts
+        i = np.repeat(q_ids, counts)
+        j = order[expandRanges(starts, counts)]
+        diff = positions[j] - queries[i]
+        dist2 = np.sum(diff * diff, axis=1)
+        if inclusive:
+            close = dist2 <= radius * radius
+        else:
+            close = dist2 < radius * radius
+        pairs_i.append(i[close])
+        pairs_j.append(j[close])
+        pairs_dist2.append(dist2[close])
+
+    pairs_i = np.concatenate(pairs_i)
+    pairs_j = np.concatenate(pairs_j)
+    pairs_order = np.lexsort((pairs_j, pairs_i))
+    neighbors_ids = pairs_j[pairs_order]
+    neighbors_offsets = np.zeros(queries_count + 1, dtype=np.int64)
+    neighbors_offsets[1:] = np.cumsum(np.bincount(pairs_i, minlength=queries_count))
+    if return_dist:
+        return neighbors_offsets, neighbors_ids, np.concatenate(pairs_dist2)[pairs_order]
+    return neighbors_offsets, neighbors_ids
+
+def getRadiusNeighbors(positions, radius, inclusive=False):
+    # neighbors closer than radius (or not farther than radius, if inclusive)
+    # without the point itself for all points, in the CSR format
+    # (see queryRadiusNeighbors)
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    points_count = len(positions)
+    neighbors_offsets, neighbors_ids = queryRadiusNeighbors(positions, positions, radius, inclusive)
+    owners = np.repeat(np.arange(points_count), np.diff(neighbors_offsets))
+    not_self = neighbors_ids != owners
+    neighbors_offsets = np.zeros(points_count + 1, dtype=np.int64)
+    neighbors_offsets[1:] = np.cumsum(np.bincount(owners[not_self], minlength=points_count))
+    return neighbors_offsets, neighbors_ids[not_self]
+
+def getSeparatedSubset(positions, p_dist, mask=None, first_idx=None, seed=None, neighbors=None):
+    # greedy subset of points (optionally only points with mask set) in which
+    # all points are farther than p_dist from each other; the first point is
+    # first_idx or a random one (deterministic if seed is given), the next
+    # points are taken in the order of indices; returns the list of indices.
+    # neighbors may be the result of
+    # getRadiusNeighbors(positions, p_dist, inclusive=True) for all points,
+    # reused for different masks
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    if mask is None:
+        candidates = np.arange(len(positions))
+    else:
+        candidates = np.nonzero(mask)[0]
+    if len(candidates) == 0:
+        return []
+
+    if first_idx == None:
+        if seed == None:
+            first_idx = candidates[random.randint(0, len(candidates)-1)]
+        else:
+            first_idx = candidates[random.Random(seed).randint(0, len(candidates)-1)]
+
+    if neighbors is not None:
+        # marking the points that are not candidates does not change the result
+        neighbors_offsets, neighbors_ids = neighbors
+        neighbors_offsets = neighbors_offsets.tolist()
+        removed = np.zeros(len(positions), dtype=bool)
+        subset = []
+        for idx in [int(first_idx)] + candidates.tolist():
+            if removed[idx]:
+                continue
+            subset.append(idx)
+            removed[idx] = True
+            removed[neighbors_ids[neighbors_offsets[idx]:neighbors_offsets[idx+1]]] = True
+        return subset
+
+    neighbors_offsets, neighbors_ids = getRadiusNeighbors(positions[candidates], p_dist, inclusive=True)
+    neighbors_offsets = neighbors_offsets.tolist()
+
+    removed = np.zeros(len(candidates), dtype=bool)
+    first_local = int(np.searchsorted(candidates, first_idx))
+    subset = []
+    for idx in [first_local] + range(len(candidates)):
+        if removed[idx]:
+            continue
+        subset.append(int(candidates[idx]))
+        removed[idx] = True
+        removed[neighbors_ids[neighbors_offsets[idx]:neighbors_offsets[idx+1]]] = True
+    return subset
+
+def setRadiusNeighbors(points, radius):
+    positions = np.array([[pt.pos[0], pt.pos[1], pt.pos[2]] for pt in points])
+    neighbors_offsets, neighbors_ids = getRadiusNeighbors(positions, radius)
+    for pt_id in range(len(points)):
+        points[pt_id].neighbors_id = neighbors_ids[neighbors_offsets[pt_id]:neighbors_offsets[pt_id+1]].tolist()
+
+def computePrincipalCurvatures(points, normals, radius, plane_threshold=0.2, edge_threshold=0.2, max_pairs=2000000):
+    # batched version of pclPrincipalCurvaturesEstimation: the neighborhood of
+    # each point are all points closer than radius (including the point);
+    # returns arrays: pc1 (N), pc2 (N), principal directions (N,3) and
+    # labels (N): 0 - plane (pc1 < plane_threshold), 1 - edge
+    # (pc2 < edge_threshold), 2 - point
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    normals = np.asarray(normals, dtype=np.float64).reshape(-1, 3)
+    points_count = len(points)
+    if points_count == 0:
+        return np.zeros(0), np.zeros(0), np.zeros((0,3)), np.zeros(0, dtype=np.uint8)
+
+    neighbors_offsets, neighbors_ids = getRadiusNeighbors(points, radius)
+    neighbors_count = np.diff(neighbors_offsets) + 1
+
+    # sums of the projected normals and of their outer products
+    sum_p = np.zeros((points_count, 3))
+    sum_pp = np.zeros((points_count, 3, 3))
+    components = [(0,0), (0,1), (0,2), (1,1), (1,2), (2,2)]
+    pt_begin = 0
+    while pt_begin < points_count:
+        pt_end = np.searchsorted(neighbors_offsets, neighbors_offsets[pt_begin] + max_pairs, side='right')
+        pt_end = min(max(pt_end - 1, pt_begin + 1), points_count)
+        pt_ids = np.arange(pt_begin, pt_end)
+        # every point belongs to its own neighborhood
+        i = np.concatenate((pt_ids, np.repeat(pt_ids, np.diff(neighbors_offsets[pt_begin:pt_end+1]))))
+        j = np.concatenate((pt_ids, neighbors_ids[neighbors_offsets[pt_begin]:neighbors_offsets[pt_end]]))
+        i_local = i - pt_begin
+        # project the normals into the tangent plane: (I - n_i * n_i^T) * n_j
+        n_i = normals[i]
+        n_j = normals[j]
+        proj = n_j - n_i * np.sum(n_i * n_j, axis=1).reshape(-1, 1)
+        for dim in range(3):
+            sum_p[pt_begin:pt_end, dim] = np.bincount(i_local, weights=proj[:,dim], minlength=len(pt_ids))
+        for d1, d2 in components:
+            s = np.bincount(i_local, weights=proj[:,d1]*proj[:,d2], minlength=len(pt_ids))
+            sum_pp[pt_begin:pt_end, d1, d2] = s
+            sum_pp[pt_begin:pt_end, d2, d1] = s
+        pt_begin = pt_end
+
+    # covariance of the projected normals (not normalized, as in PCL)
+    centroid = sum_p / neighbors_count.reshape(-1, 1)
+    covariance = sum_pp - neighbors_count.reshape(-1, 1, 1) * centroid.reshape(-1, 3, 1) * centroid.reshape(-1, 1, 3)
+
+    # eigenvalues are in ascending order
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    pc1 = eigenvalues[:,2]
+    pc2 = eigenvalues[:,1]
+    directions = eigenvectors[:,:,2]
+
+    labels = np.empty(points_count, dtype=np.uint8)
+    labels.fill(2)
+    labels[pc2 < edge_threshold] = 1
+    labels[pc1 < plane_threshold] = 0
+
+    return pc1, pc2, directions, labels
+
+def setPrincipalCurvatures(surf_points, radius):
+    # calculates the curvature for all surface points and fills
+    # frame, pc1, pc2, is_plane, is_edge and is_point fields
+    points = np.array([[pt.pos[0], pt.pos[1], pt.pos[2]] for pt in surf_points])
+    normals = np.array([[pt.normal[0], pt.normal[1], pt.normal[2]] for pt in surf_points])
+    pc1, pc2, directions, labels = computePrincipalCurvatures(points, normals, radius)
+    for pt_idx in range(len(surf_points)):
+        pt = surf_points[pt_idx]
+        nx = PyKDL.Vector(directions[pt_idx,0], directions[pt_idx,1], directions[pt_idx,2])
+        pt.frame = PyKDL.Frame(PyKDL.Rotation(nx, pt.normal * nx, pt.normal), pt.pos)
+        pt.pc1 = pc1[pt_idx]
+        pt.pc2 = pc2[pt_idx]
+        pt.is_plane = bool(labels[pt_idx] == 0)
+        pt.is_edge = bool(labels[pt_idx] == 1)
+        pt.is_point = bool(labels[pt_idx] == 2)
+    return labels
+
 def sampleMeshDetailedRandom(vertices, faces, sample_dist):
     point_id = 0
     points = []
@@ -326,13 +802,7 @@ def sampleMeshDetailedRandom(vertices, faces, sample_dist):
 #    face_start_point_id.append(point_id)
 
 ####
-    for pt_id in range(len(points)):
-        for pt_id2 in range(len(points)):
-            if pt_id2 == pt_id:
-                continue
-            dist = (points[pt_id].pos - points[pt_id2].pos).Norm()
-            if dist < sample_dist*1.2:
-                points[pt_id].neighbors_id.append(pt_id2)
+    setRadiusNeighbors(points, sample_dist*1.2)
 
     return points
 
@@ -398,13 +868,7 @@ def sampleMeshDetailed(vertices, faces, sample_dist):
     face_start_point_id.append(point_id)
 
 ####
-    for pt_id in range(len(points)):
-        for pt_id2 in range(len(points)):
-            if pt_id2 == pt_id:
-                continue
-            dist = (points[pt_id].pos - points[pt_id2].pos).Norm()
-            if dist < sample_dist*1.2:
-                points[pt_id].neighbors_id.append(pt_id2)
+    setRadiusNeighbors(points, sample_dist*1.2)
 
     return points
 ####
@@ -425,82 +889,116 @@ def sampleMeshDetailed(vertices, faces, sample_dist):
         
     return points
 
-def sampleMeshDetailedRays(vertices, faces, sample_dist):
-
-    dim_min = [None, None, None]
-    dim_max = [None, None, None]
-    for v in vertices:
-        for dim in range(3):
-            if dim_min[dim] == None or dim_min[dim] > v[dim]:
-                dim_min[dim] = v[dim]
-            if dim_max[dim] == None or dim_max[dim] < v[dim]:
-                dim_max[dim] = v[dim]
-
-    rays_dim = [None, None, None]
-    for dim in range(3):
-        dim_min[dim] += 0.5 * sample_dist
-#        rays_dim[i] = np.arange(dim_min[dim], dim_max[dim], sample_dist)
-
-    other_dim = [[1,2],[0,2],[0,1]]
-
-    point_id = 0
-    points = []
-
-    for face in faces:
-        A = vertices[face[0]]
-        B = vertices[face[1]]
-        C = vertices[face[2]]
-        pt_a = PyKDL.Vector(A[0],A[1],A[2])
-        pt_b = PyKDL.Vector(B[0],B[1],B[2])
-        pt_c = PyKDL.Vector(C[0],C[1],C[2])
-        v0 = pt_b - pt_a
-        v1 = pt_c - pt_a
-        # calculate the face normal
-        normal = v0 * v1
-        normal.Normalize()
-        # calculate the distance of the face from the origin
-        fd = -PyKDL.dot(pt_a, normal)
-        # get the direction (x,y,z) the face is pointing to
-        normal_max = 0.0
-        normal_max_dim = None
-        for dim in range(3):
-            if abs(normal[dim]) > normal_max:
-                normal_max = abs(normal[dim])
-                normal_max_dim = dim
-        dimensions = other_dim[normal_max_dim]
-        fdim_min = [None, None, None]
-        fdim_max = [None, None, None]
-        for pt in [pt_a, pt_b, pt_c]:
-            for dim in range(3):
-                if fdim_min[dim] == None or fdim_min[dim] > pt[dim]:
-                    fdim_min[dim] = pt[dim]
-                if fdim_max[dim] == None or fdim_max[dim] < pt[dim]:
-                    fdim_max[dim] = pt[dim]
-
-        n0_count = math.ceil((fdim_min[dimensions[0]] - dim_min[dimensions[0]])/sample_dist)
-        n1_count = math.ceil((fdim_min[dimensions[1]] - dim_min[dimensions[1]])/sample_dist)
-
-        for d0 in np.arange(dim_min[dimensions[0]] + sample_dist * n0_count, fdim_max[dimensions[0]], sample_dist):
-            for d1 in np.arange(dim_min[dimensions[1]] + sample_dist * n1_count, fdim_max[dimensions[1]], sample_dist):
-                pt_in = pointInTriangle([pt_a[dimensions[0]], pt_a[dimensions[1]]],
-                [pt_b[dimensions[0]], pt_b[dimensions[1]]],
-                [pt_c[dimensions[0]], pt_c[dimensions[1]]], [d0, d1])
-                if pt_in:
-                    d2 = -(normal[dimensions[0]]*d0 + normal[dimensions[1]]*d1 + fd)/normal[normal_max_dim]
-                    pt_tuple = [None, None, None]
-                    pt_tuple[dimensions[0]] = d0
-                    pt_tuple[dimensions[1]] = d1
-                    pt_tuple[normal_max_dim] = d2
-                    surf_pt = SurfacePoint()
-                    surf_pt.id = point_id
-                    surf_pt.pos = PyKDL.Vector(pt_tuple[0], pt_tuple[1], pt_tuple[2])
-                    surf_pt.normal = normal
-                    points.append(surf_pt)
-                    point_id += 1
+def rasterizeMeshRays(vertices, faces, sample_dist, max_candidates=2000000):
+    # the rays of a regular grid (with the step sample_dist) are cast onto
+    # each face along the axis closest to the face normal; all faces are
+    # processed in batches of at most max_candidates grid points and the
+    # result is a pair of (N,3) arrays: positions and normals of the points
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    if len(faces) == 0:
+        return np.zeros((0,3)), np.zeros((0,3))
+
+    dim_min = np.min(vertices, axis=0) + 0.5 * sample_dist
+
+    pt_a = vertices[faces[:,0]]
+    pt_b = vertices[faces[:,1]]
+    pt_c = vertices[faces[:,2]]
+
+    # calculate the face normals
+    face_normals = np.cross(pt_b - pt_a, pt_c - pt_a)
+    normals_len = np.sqrt(np.sum(face_normals * face_normals, axis=1))
+    # the same as PyKDL.Vector.Normalize: (nearly) degenerate faces get (1,0,0)
+    degenerate = normals_len < 1e-6
+    face_normals[~degenerate] /= normals_len[~degenerate].reshape(-1, 1)
+    face_normals[degenerate] = [1.0, 0.0, 0.0]
+    # calculate the distance of the faces from the origin
+    fd = -np.sum(pt_a * face_normals, axis=1)
+    # get the direction (x,y,z) the faces are pointing to
+    normal_max_dim = np.argmax(np.abs(face_normals), axis=1)
+    other_dim = np.array([[1,2],[0,2],[0,1]])
+    dimensions = other_dim[normal_max_dim]
+
+    face_ids = np.arange(len(faces)).reshape(-1, 1)
+    fdim_min = np.minimum(np.minimum(pt_a, pt_b), pt_c)[face_ids, dimensions]
+    fdim_max = np.maximum(np.maximum(pt_a, pt_b), pt_c)[face_ids, dimensions]
+    tri_a = pt_a[face_ids, dimensions]
+    tri_b = pt_b[face_ids, dimensions]
+    tri_c = pt_c[face_ids, dimensions]
+    normal_d = face_normals[face_ids, dimensions]
+    normal_max = face_normals[face_ids[:,0], normal_max_dim]
+
+    # the first ray and the number of rays in both directions for each face,
+    # the same as in np.arange(grid_start, fdim_max, sample_dist)
+    grid_start = dim_min[dimensions] + sample_dist * np.ceil((fdim_min - dim_min[dimensions])/sample_dist)
+    grid_step = (grid_start + sample_dist) - grid_start
+    grid_count = np.maximum(np.ceil((fdim_max - grid_start)/sample_dist), 0).astype(np.int64)
+    face_candidates = grid_count[:,0] * grid_count[:,1]
+    face_candidates_cum = np.cumsum(face_candidates)
+
+    positions = []
+    normals = []
+    face_begin = 0
+    while face_begin < len(faces):
+        candidates_before = face_candidates_cum[face_begin] - face_candidates[face_begin]
+        face_end = np.searchsorted(face_candidates_cum, candidates_before + max_candidates, side='right')
+        face_end = max(face_end, face_begin + 1)
+
+        f_ids = np.arange(face_begin, face_end)
+        face_begin = face_end
+        cand_face = np.repeat(f_ids, face_candidates[f_ids])
+        if len(cand_face) == 0:
+            continue
+        cand_local = expandRanges(np.zeros(len(f_ids)), face_candidates[f_ids])
+        k0 = cand_local // grid_count[cand_face,1]
+        k1 = cand_local % grid_count[cand_face,1]
+        d0 = grid_start[cand_face,0] + k0 * grid_step[cand_face,0]
+        d1 = grid_start[cand_face,1] + k1 * grid_step[cand_face,1]
+
+        # barycentric test, the same as in pointInTriangle
+        ax = tri_a[cand_face,0]
+        ay = tri_a[cand_face,1]
+        v0x = tri_c[cand_face,0] - ax
+        v0y = tri_c[cand_face,1] - ay
+        v1x = tri_b[cand_face,0] - ax
+        v1y = tri_b[cand_face,1] - ay
+        v2x = d0 - ax
+        v2y = d1 - ay
+        dot00 = v0x*v0x + v0y*v0y
+        dot01 = v0x*v1x + v0y*v1y
+        dot02 = v0x*v2x + v0y*v2y
+        dot11 = v1x*v1x + v1y*v1y
+        dot12 = v1x*v2x + v1y*v2y
+        denom = dot00 * dot11 - dot01 * dot01
+        valid = denom != 0.0
+        inv_denom = 1.0 / np.where(valid, denom, 1.0)
+        u = (dot11 * dot02 - dot01 * dot12) * inv_denom
+        v = (dot00 * dot12 - dot01 * dot02) * inv_denom
+        pt_in = valid & (u >= 0) & (v >= 0) & (u + v < 1)
+
+        cand_face = cand_face[pt_in]
+        d0 = d0[pt_in]
+        d1 = d1[pt_in]
+        d2 = -(normal_d[cand_face,0]*d0 + normal_d[cand_face,1]*d1 + fd[cand_face])/normal_max[cand_face]
+        pos = np.empty((len(cand_face), 3))
+        pt_ids = np.arange(len(cand_face))
+        pos[pt_ids, dimensions[cand_face,0]] = d0
+        pos[pt_ids, dimensions[cand_face,1]] = d1
+        pos[pt_ids, normal_max_dim[cand_face]] = d2
+        positions.append(pos)
+        normals.append(face_normals[cand_face])
+
+    if len(positions) == 0:
+        return np.zeros((0,3)), np.zeros((0,3))
+    return np.concatenate(positions), np.concatenate(normals)
+
+def setSectorNeighborsLoop(points, sample_dist, dim_min, dim_max):
+    # original per-point version of getSectorNeighbors, operating on
+    # the list of SurfacePoints; used only for the comparison in the tests
+    dim_max = list(dim_max)
 
     # put the points in voxels
     for dim in range(3):
-        dim_min[dim] -= 0.5 * sample_dist
         dim_max[dim] += 1.5 * sample_dist
 
     def getPointIndex(pt):
@@ -583,8 +1081,295 @@ def sampleMeshDetailedRays(vertices, faces, sample_dist):
             if not p.id in points[s[1]].neighbors_id:
                 points[s[1]].neighbors_id.append(p.id)
 
+
+def getSectorGrid(positions, sample_dist, dim_min, voxel_size=10.0):
+    # voxel indices used by the six-sector neighbor search
+    return np.trunc((positions - dim_min) / (sample_dist * voxel_size)).astype(np.int64)
+
+def getSectors(diff):
+    # sector (+x -x +y -y +z -z) of each difference vector; the conditions are
+    # checked in the same order as in the per-point version
+    x = diff[:,0]
+    y = diff[:,1]
+    z = diff[:,2]
+    ax = np.abs(x)
+    ay = np.abs(y)
+    az = np.abs(z)
+    sectors = np.full(len(diff), -1, dtype=np.int64)
+    conditions = [
+        (ay <= x) & (az <= x),
+        (ay <= -x) & (az <= -x),
+        (az <= y) & (ax <= y),
+        (az <= -y) & (ax <= -y),
+        (ax <= z) & (ay <= z),
+        (ax <= -z) & (ay <= -z)]
+    for sect in range(6):
+        sectors[(sectors < 0) & conditions[sect]] = sect
+    return sectors
+
+def getSectorNeighbors(positions, sample_dist, dim_min, voxel_size=10.0):
+    # for every point finds the closest point (not farther than 2*sample_dist)
+    # in each of the six sectors around it and connects them symmetrically;
+    # the candidates are taken from the voxels (of size voxel_size*sample_dist)
+    # idx-1 and idx in each dimension, as in setSectorNeighborsLoop.
+    # Returns the neighbors in the CSR format, in the same order as the lists
+    # built by setSectorNeighborsLoop (including the point itself)
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    points_count = len(positions)
+    max_dist = sample_dist * 2.0
+    offsets, q, dist2 = queryRadiusNeighbors(positions, positions, max_dist * (1.0 + 1e-9), inclusive=True, return_dist=True)
+    p = np.repeat(np.arange(points_count, dtype=np.int64), np.diff(offsets))
+
+    dist = np.sqrt(dist2)
+    cells = getSectorGrid(positions, sample_dist, dim_min, voxel_size)
+    cells_diff = cells[q] - cells[p]
+    valid = (dist <= max_dist) & np.all((cells_diff == -1) | (cells_diff == 0), axis=1)
+    p = p[valid]
+    q = q[valid]
+    dist = dist[valid]
+    cells_diff = cells_diff[valid]
+    sectors = getSectors(positions[q] - positions[p])
+
+    # the closest candidate in each sector; ties are resolved by the order
+    # of the candidates in the loop version: voxels (x, y, z) and point id
+    voxel_rank = (cells_diff[:,0] + 1) * 4 + (cells_diff[:,1] + 1) * 2 + (cells_diff[:,2] + 1)
+    order = np.lexsort((q, voxel_rank, dist, sectors, p))
+    p = p[order]
+    q = q[order]
+    sectors = sectors[order]
+    first = np.ones(len(p), dtype=bool)
+    first[1:] = (p[1:] != p[:-1]) | (sectors[1:] != sectors[:-1])
+    p = p[first]
+    q = q[first]
+    sectors = sectors[first]
+
+    # point p adds q to its list, then q adds p to its list, for the sectors
+    # in order and for the points in order; only the first addition counts
+    owners = np.concatenate((p, q))
+    values = np.concatenate((q, p))
+    times = np.concatenate((p * 12 + sectors * 2, p * 12 + sectors * 2 + 1))
+    order = np.lexsort((times, values, owners))
+    owners = owners[order]
+    values = values[order]
+    times = times[order]
+    first = np.ones(len(owners), dtype=bool)
+    first[1:] = (owners[1:] != owners[:-1]) | (values[1:] != values[:-1])
+    owners = owners[first]
+    values = values[first]
+    times = times[first]
+    order = np.lexsort((times, owners))
+
+    neighbors_offsets = np.zeros(points_count + 1, dtype=np.int64)
+    neighbors_offsets[1:] = np.cumsum(np.bincount(owners, minlength=points_count))
+    return neighbors_offsets, values[order]
+
+def sampleMeshDetailedRays(vertices, faces, sample_dist):
+    positions, normals = rasterizeMeshRays(vertices, faces, sample_dist)
+    neighbors_offsets, neighbors_ids = getSectorNeighbors(positions, sample_dist, np.min(np.asarray(vertices, dtype=np.float64), axis=0))
+    neighbors_offsets = neighbors_offsets.tolist()
+    neighbors_ids = neighbors_ids.tolist()
+    positions = positions.tolist()
+    normals = normals.tolist()
+
+    points = []
+    for point_id in range(len(positions)):
+        surf_pt = SurfacePoint()
+        surf_pt.id = point_id
+        surf_pt.pos = PyKDL.Vector(positions[point_id][0], positions[point_id][1], positions[point_id][2])
+        surf_pt.normal = PyKDL.Vector(normals[point_id][0], normals[point_id][1], normals[point_id][2])
+        surf_pt.neighbors_id = neighbors_ids[neighbors_offsets[point_id]:neighbors_offsets[point_id+1]]
+        points.append(surf_pt)
+
     return points
 
+#
+# multi-resolution surface
+#
+
+class SurfacePyramidLevel(object):
+
+    def __init__(self, cloud, indices, p_dist):
+        # ids of the points in the base cloud
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.positions = cloud.positions[self.indices]
+        self.normals = cloud.normals[self.indices]
+        self.surface_type = cloud.surface_type[self.indices]
+        self.p_dist = p_dist
+        # ids of the closest points on the coarser level (None for the top level)
+        self.parents = None
+        # ids of the points on the finer level, in the CSR format
+        self.children_offsets = None
+        self.children_ids = None
+        # max distance between a point of the base cloud and its ancestor on this level
+        self.cover_radius = 0.0
+
+    def __len__(self):
+        return len(self.indices)
+
+class SurfacePyramid(object):
+    # level-of-detail pyramid of SurfacePointCloud: level 0 contains all
+    # points, level k is a subset of level k-1 with points separated by
+    # base_dist * factor^(k-1); each point is linked to the closest point
+    # (parent) of the next coarser level
+
+    def __init__(self, cloud, base_dist, levels_count=4, factor=2.0, seed=None):
+        self.cloud = cloud
+        self.levels = [SurfacePyramidLevel(cloud, np.arange(len(cloud)), 0.0)]
+        # ancestors of the points of the base cloud on the top level
+        ancestors = np.arange(len(cloud))
+        p_dist = base_dist
+        for level_idx in range(1, levels_count):
+            finer = self.levels[-1]
+            if len(finer) <= 1:
+                break
+            subset = getSeparatedSubset(finer.positions, p_dist, seed=seed)
+            coarser = SurfacePyramidLevel(cloud, finer.indices[subset], p_dist)
+            finer.parents = self.getClosestIds(coarser.positions, finer.positions, p_dist)
+
+            children_order = np.argsort(finer.parents, kind='mergesort')
+            coarser.children_ids = children_order
+            coarser.children_offsets = np.zeros(len(coarser) + 1, dtype=np.int64)
+            coarser.children_offsets[1:] = np.cumsum(np.bincount(finer.parents, minlength=len(coarser)))
+
+            ancestors = finer.parents[ancestors]
+            diff = cloud.positions - coarser.positions[ancestors]
+            coarser.cover_radius = math.sqrt(np.max(np.sum(diff * diff, axis=1)))
+
+            self.levels.append(coarser)
+            p_dist *= factor
+
+    def getClosestIds(self, positions, queries, radius):
+        # id of the closest position for each query; every query point of the
+        # pyramid has a position within radius, but the search radius is
+        # increased for the points that are not found due to rounding
+        closest = np.empty(len(queries), dtype=np.int64)
+        closest.fill(-1)
+        missing = np.arange(len(queries))
+        while len(missing) > 0:
+            offsets, ids, dist2 = queryRadiusNeighbors(positions, queries[missing], radius, inclusive=True, return_dist=True)
+            counts = np.diff(offsets)
+            owners = np.repeat(np.arange(len(missing)), counts)
+            order = np.lexsort((dist2, owners))
+            found = counts > 0
+            closest[missing[found]] = ids[order][offsets[:-1][found]]
+            missing = missing[~found]
+            radius *= 2.0
+        return closest
+
+    def getChildren(self, level_idx, ids):
+        # ids of the points of level level_idx-1 that are children of ids
+        level = self.levels[level_idx]
+        ids = np.asarray(ids, dtype=np.int64)
+        starts = level.children_offsets[ids]
+        counts = level.children_offsets[ids+1] - starts
+        return level.children_ids[expandRanges(starts, counts)]
+
+    def coarseToFine(self, test, top_level=None):
+        # test(level, ids) returns a boolean mask of the points of the level
+        # to keep; it must be conservative on the coarse levels (e.g. extended
+        # by level.cover_radius), as the rejected points are not refined;
+        # returns ids of the base cloud that passed the test on all levels
+        if top_level == None:
+            top_level = len(self.levels) - 1
+        ids = np.arange(len(self.levels[top_level]))
+        for level_idx in range(top_level, -1, -1):
+            if level_idx < top_level:
+                ids = self.getChildren(level_idx + 1, ids)
+            ids = ids[test(self.levels[level_idx], ids)]
+            if len(ids) == 0:
+                break
+        return self.levels[0].indices[ids]
+
+    def getPointsInSphere(self, center, radius):
+        center = np.array([center[0], center[1], center[2]])
+        def test(level, ids):
+            diff = level.positions[ids] - center
+            return np.sum(diff * diff, axis=1) <= (radius + level.cover_radius)**2
+        return self.coarseToFine(test)
+
+#
+# cache of sampled surfaces
+#
+
+SURFACE_CACHE_VERSION = 1
+
+surface_cache_dtype = np.dtype([('positions', '<f8', (3,)), ('normals', '<f4', (3,)), ('directions', '<f4', (3,)),
+    ('pc1', '<f4'), ('pc2', '<f4'), ('surface_type', 'u1')])
+
+def getSurfaceCacheDir():
+    ros_home = os.environ.get('ROS_HOME', os.path.join(os.path.expanduser('~'), '.ros'))
+    return os.path.join(ros_home, 'barrett_hand_surface_cache')
+
+def getSurfaceCacheKey(vertices, faces, sampling_function, sample_dist, curvature_radius):
+    # the key depends on the content of the mesh and on all parameters
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(vertices, dtype=np.float64).tostring())
+    h.update(np.ascontiguousarray(faces, dtype=np.int64).tostring())
+    h.update("%s %s %r %r"%(SURFACE_CACHE_VERSION, sampling_function.__name__, float(sample_dist), curvature_radius))
+    return h.hexdigest()
+
+def saveSurfacePointCloud(cloud, filename):
+    records = np.zeros(len(cloud), dtype=surface_cache_dtype)
+    records['positions'] = cloud.positions
+    records['normals'] = cloud.normals
+    records['directions'] = cloud.directions
+    records['pc1'] = cloud.pc1
+    records['pc2'] = cloud.pc2
+    records['surface_type'] = cloud.surface_type
+    neighbors = np.concatenate((cloud.neighbors_offsets, cloud.neighbors_ids)).astype(np.int32)
+
+    # write to temporary files first, so other processes never see partial data
+    dirname = os.path.dirname(os.path.abspath(filename))
+    tmp_files = []
+    for data, suffix in ((records, '.npy'), (neighbors, '_neighbors.npy')):
+        fd, tmp_filename = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, data)
+        tmp_files.append((tmp_filename, filename + suffix))
+    for tmp_filename, final_filename in reversed(tmp_files):
+        os.rename(tmp_filename, final_filename)
+
+def loadSurfacePointCloud(filename, mmap_mode='r'):
+    records = np.load(filename + '.npy', mmap_mode=mmap_mode)
+    neighbors = np.load(filename + '_neighbors.npy', mmap_mode=mmap_mode)
+    points_count = len(records)
+    cloud = SurfacePointCloud(records['positions'], records['normals'], neighbors[:points_count+1], neighbors[points_count+1:])
+    cloud.directions = records['directions']
+    cloud.pc1 = records['pc1']
+    cloud.pc2 = records['pc2']
+    cloud.surface_type = records['surface_type']
+    return cloud
+
+def sampleMeshCached(vertices, faces, sample_dist, curvature_radius=None, sampling_function=None, cache_dir=None):
+    # returns SurfacePointCloud with the sampled surface of the mesh (and its
+    # curvature, if curvature_radius is given); the result is stored in
+    # cache_dir and memory-mapped on the next calls with the same mesh and
+    # parameters
+    if sampling_function == None:
+        sampling_function = sampleMeshDetailedRays
+    if cache_dir == None:
+        cache_dir = getSurfaceCacheDir()
+    key = getSurfaceCacheKey(vertices, faces, sampling_function, sample_dist, curvature_radius)
+    filename = os.path.join(cache_dir, key)
+
+    if os.path.isfile(filename + '.npy') and os.path.isfile(filename + '_neighbors.npy'):
+        try:
+            return loadSurfacePointCloud(filename)
+        except (IOError, ValueError) as e:
+            print "sampleMeshCached: could not read the cache file %s: %s"%(filename, e)
+
+    cloud = SurfacePointCloud.fromSurfacePoints(sampling_function(vertices, faces, sample_dist))
+    if curvature_radius != None:
+        cloud.computeCurvatures(curvature_radius)
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        saveSurfacePointCloud(cloud, filename)
+    except (IOError, OSError) as e:
+        print "sampleMeshCached: could not write the cache file %s: %s"%(filename, e)
+    return cloud
+
 #
 # Unit tests
 #
@@ -660,4 +1445,55 @@ def testSurfaceCurvature2(pub_marker, vertices, faces, T_W_O):
 
                 raw_input("Press ENTER to continue...")
 
-
+def testRadiusNeighbors(points_count=2000, radius=0.0012):
+    # compare the grid-based neighbors with the brute-force search
+    positions = np.random.uniform(-0.01, 0.01, (points_count, 3))
+    positions[:,2] *= 0.1
+    neighbors_offsets, neighbors_ids = getRadiusNeighbors(positions, radius)
+    errors = 0
+    for pt_id in range(points_count):
+        dist = np.sqrt(np.sum((positions - positions[pt_id])**2, axis=1))
+        expected = [pt_id2 for pt_id2 in range(points_count) if pt_id2 != pt_id and dist[pt_id2] < radius]
+        if expected != neighbors_ids[neighbors_offsets[pt_id]:neighbors_offsets[pt_id+1]].tolist():
+            errors += 1
+    print "testRadiusNeighbors: points: %s  neighbors: %s  errors: %s"%(points_count, len(neighbors_ids), errors)
+    return errors == 0
+
+def testSectorNeighbors(vertices, faces, sample_dist=0.0015):
+    # compare the vectorized six-sector neighbors with the per-point version
+    vertices = np.asarray(vertices, dtype=np.float64)
+    positions, normals = rasterizeMeshRays(vertices, faces, sample_dist)
+    points = []
+    for point_id in range(len(positions)):
+        surf_pt = SurfacePoint()
+        surf_pt.id = point_id
+        surf_pt.pos = PyKDL.Vector(positions[point_id][0], positions[point_id][1], positions[point_id][2])
+        points.append(surf_pt)
+
+    t0 = time.time()
+    setSectorNeighborsLoop(points, sample_dist, np.min(vertices, axis=0).tolist(), np.max(vertices, axis=0).tolist())
+    t1 = time.time()
+    neighbors_offsets, neighbors_ids = getSectorNeighbors(positions, sample_dist, np.min(vertices, axis=0))
+    t2 = time.time()
+    errors = 0
+    for pt_id in range(len(points)):
+        if points[pt_id].neighbors_id != neighbors_ids[neighbors_offsets[pt_id]:neighbors_offsets[pt_id+1]].tolist():
+            errors += 1
+    print "testSectorNeighbors: points: %s  neighbors: %s  errors: %s  loop: %ss  vectorized: %ss"%(len(points), len(neighbors_ids), errors, t1-t0, t2-t1)
+    return errors == 0
+
+def testSamplerNeighbors(vertices, faces, sample_dist=0.0015):
+    # compare the neighbors set by the mesh samplers with the brute-force search
+    result = True
+    for sampling_function in [sampleMeshDetailed, sampleMeshDetailedRandom]:
+        points = sampling_function(vertices, faces, sample_dist)
+        positions = np.array([[pt.pos[0], pt.pos[1], pt.pos[2]] for pt in points]).reshape(-1, 3)
+        errors = 0
+        for pt_id in range(len(points)):
+            dist = np.sqrt(np.sum((positions - positions[pt_id])**2, axis=1))
+            expected = [pt_id2 for pt_id2 in range(len(points)) if pt_id2 != pt_id and dist[pt_id2] < sample_dist*1.2]
+            if expected != points[pt_id].neighbors_id:
+                errors += 1
+        print "testSamplerNeighbors: %s: points: %s  errors: %s"%(sampling_function.__name__, len(points), errors)
+        result = result and errors == 0 and len(points) > 0
+    return result
@@ -69,6 +69,12 @@ import velmautils
 import surfaceutils
 import openraveinstance
 import itertools
+import os
+import sys
+import tempfile
+import time
+import multiprocessing
+import multiprocessing.sharedctypes
 import dijkstra
 import grip
 import operator
@@ -91,65 +97,77 @@ class GraspsVoxelGrid:
         self.dim_max = [None, None, None]
 
     def build(self, grasps):
-        for grasp in grasps:
-            v = grasp[0]
-            for dim in range(3):
-                if self.dim_min[dim] == None or self.dim_min[dim] > v[dim]:
-                    self.dim_min[dim] = v[dim]
-                if self.dim_max[dim] == None or self.dim_max[dim] < v[dim]:
-                    self.dim_max[dim] = v[dim]
+        # the grasps are stored in an array sorted by the linearized voxel
+        # index (keeping the order of grasps within a voxel); the grasps of
+        # the voxel with index k are grasps_sorted[offsets[k]:offsets[k+1]]
+        self.grasps = grasps
+        positions = np.array([[grasp[0][0], grasp[0][1], grasp[0][2]] for grasp in grasps], dtype=np.float64).reshape(-1, 3)
+        self.dim_min = np.min(positions, axis=0).tolist()
+        self.dim_max = np.max(positions, axis=0).tolist()
 
         self.grid_size = self.getPointIndex(self.dim_max)
         self.grid_size = (self.grid_size[0] + 1, self.grid_size[1] + 1, self.grid_size[2] + 1)
 
-        self.grid = []
-        for x in range(self.grid_size[0]):
-            self.grid.append([])
-            for y in range(self.grid_size[1]):
-                self.grid[-1].append([])
-                for z in range(self.grid_size[2]):
-                    self.grid[-1][-1].append([])
-                    self.grid[-1][-1][-1] = []
-
-        # add all points to the voxel map
-        self.max_points_in_voxel = 0
-        for grasp in grasps:
-            idx = self.getPointIndex(grasp[0])
-            self.grid[idx[0]][idx[1]][idx[2]].append(grasp)
-            voxel_points_count = len(self.grid[idx[0]][idx[1]][idx[2]])
-            if voxel_points_count > self.max_points_in_voxel:
-                self.max_points_in_voxel = voxel_points_count
+        cells = np.trunc((positions - np.array(self.dim_min)) / self.voxel_size).astype(np.int64)
+        keys = (cells[:,0] * self.grid_size[1] + cells[:,1]) * self.grid_size[2] + cells[:,2]
+        self.order = np.argsort(keys, kind='mergesort')
+        self.positions = positions[self.order]
+        voxels_count = self.grid_size[0] * self.grid_size[1] * self.grid_size[2]
+        counts = np.bincount(keys, minlength=voxels_count)
+        self.offsets = np.zeros(voxels_count+1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(counts)
+        self.max_points_in_voxel = int(np.max(counts))
+
+    def getPointsAtPoints(self, centers, radius, exact=False, batch_size=100000):
+        # batch version of getPointsAtPoint for the (N,3) array of centers;
+        # returns the indices of grasps (in the list given to build) in the CSR
+        # format: grasps close to the center i are
+        # ids[offsets[i]:offsets[i+1]], in the same order as returned by
+        # getPointsAtPoint; if exact is set, only the grasps closer than
+        # radius are returned
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+        dim_min = np.array(self.dim_min)
+        grid_size = np.array(self.grid_size, dtype=np.int64)
+        span = int(math.ceil(2.0 * radius / self.voxel_size)) + 2
+        counts_all = []
+        ids_all = []
+        for batch_begin in range(0, len(centers), batch_size):
+            batch = centers[batch_begin:batch_begin+batch_size]
+            min_index = np.maximum(np.trunc((batch - radius - dim_min) / self.voxel_size).astype(np.int64), 0)
+            max_index = np.minimum(np.trunc((batch + radius - dim_min) / self.voxel_size).astype(np.int64), grid_size - 1)
+            pairs_i = []
+            pairs_j = []
+            for offset in itertools.product(range(span), repeat=3):
+                cells = min_index + np.array(offset, dtype=np.int64)
+                voxel_centers = (cells + 0.5) * self.voxel_size + dim_min
+                valid = np.all(cells <= max_index, axis=1) & (np.sqrt(np.sum((voxel_centers - batch)**2, axis=1)) <= self.voxel_max_radius + radius)
+                i = np.nonzero(valid)[0]
+                cells = cells[i]
+                keys = (cells[:,0] * grid_size[1] + cells[:,1]) * grid_size[2] + cells[:,2]
+                starts = self.offsets[keys]
+                counts = self.offsets[keys+1] - starts
+                pairs_i.append(np.repeat(i, counts))
+                pairs_j.append(surfaceutils.expandRanges(starts, counts))
+            pairs_i = np.concatenate(pairs_i)
+            pairs_j = np.concatenate(pairs_j)
+            if exact:
+                close = np.sqrt(np.sum((self.positions[pairs_j] - batch[pairs_i])**2, axis=1)) < radius
+                pairs_i = pairs_i[close]
+                pairs_j = pairs_j[close]
+            # the sorted index follows the order of voxels and of grasps within voxels
+            pairs_order = np.lexsort((pairs_j, pairs_i))
+            counts_all.append(np.bincount(pairs_i, minlength=len(batch)))
+            ids_all.append(self.order[pairs_j[pairs_order]])
+
+        offsets = np.zeros(len(centers)+1, dtype=np.int64)
+        if len(centers) == 0:
+            return offsets, np.zeros(0, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.concatenate(counts_all))
+        return offsets, np.concatenate(ids_all)
 
     def getPointsAtPoint(self, pos, radius):
-        min_index = self.getPointIndexList(pos - PyKDL.Vector(radius, radius, radius))
-        max_index = self.getPointIndexList(pos + PyKDL.Vector(radius, radius, radius))
-        for dof in range(3):
-            if min_index[dof] < 0:
-                min_index[dof] = 0
-            if max_index[dof] >= self.grid_size[dof]:
-                max_index[dof] = self.grid_size[dof]-1
-
-        # get the indices of voxels around the current point
-        voxel_indices = []
-        for x in range(min_index[0], max_index[0]+1):
-            for y in range(min_index[1], max_index[1]+1):
-                for z in range(min_index[2], max_index[2]+1):
-                    voxel_center = PyKDL.Vector((x+0.5) * self.voxel_size + self.dim_min[0], (y+0.5) * self.voxel_size + self.dim_min[1], (z+0.5) * self.voxel_size + self.dim_min[2])
-                    if (voxel_center-pos).Norm() > self.voxel_max_radius + radius:
-                        continue
-                    voxel_indices.append((x,y,z))
-
-        grasps_in_sphere = []
-        for idx in voxel_indices:
-            x,y,z = idx
-            grasps_in_sphere += self.grid[x][y][z]
-#            for grasp in self.grid[x][y][z]:
-#                pt_diff = grasp[0]-pos
-#                dist = pt_diff.Norm()
-#                if dist < radius:
-#                    grasps_in_sphere.append(grasp)
-
-        return grasps_in_sphere
+        offsets, ids = self.getPointsAtPoints([[pos[0], pos[1], pos[2]]], radius)
+        return [self.grasps[i] for i in ids]
 
 class VoxelGrid:
 
@@ -165,50 +183,49 @@ class VoxelGrid:
         self.dim_min = [None, None, None]
         self.dim_max = [None, None, None]
 
+    def getVoxelKeys(self, positions):
+        # linearized voxel indices of the (N,3) array of positions
+        cells = np.trunc((positions - np.array(self.dim_min)) / self.voxel_size).astype(np.int64)
+        return (cells[:,0] * self.grid_size[1] + cells[:,1]) * self.grid_size[2] + cells[:,2]
+
+    def sortPoints(self, points, positions):
+        # sorts the points by the linearized voxel index (keeping the order of
+        # points within a voxel); the points of the voxel with index k are
+        # points_sorted[offsets[k]:offsets[k+1]]
+        voxels_count = self.grid_size[0] * self.grid_size[1] * self.grid_size[2]
+        if len(points) == 0:
+            return [], np.zeros((0,3)), np.zeros(voxels_count+1, dtype=np.int64), 0
+        keys = self.getVoxelKeys(positions)
+        order = np.argsort(keys, kind='mergesort')
+        counts = np.bincount(keys, minlength=voxels_count)
+        offsets = np.zeros(voxels_count+1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        return [points[i] for i in order], positions[order], offsets, int(np.max(counts))
+
     def build(self, points, points_forbidden):
-        for pt in points + points_forbidden:
-            v = pt[1]
-            for dim in range(3):
-                if self.dim_min[dim] == None or self.dim_min[dim] > v[dim]:
-                    self.dim_min[dim] = v[dim]
-                if self.dim_max[dim] == None or self.dim_max[dim] < v[dim]:
-                    self.dim_max[dim] = v[dim]
+        # the points are stored in flat arrays sorted by the voxel index
+        # instead of the lists of points for every voxel
+        positions = np.array([[pt[1][0], pt[1][1], pt[1][2]] for pt in points + points_forbidden], dtype=np.float64).reshape(-1, 3)
+        self.dim_min = np.min(positions, axis=0).tolist()
+        self.dim_max = np.max(positions, axis=0).tolist()
 
         self.grid_size = self.getPointIndex(self.dim_max)
         self.grid_size = (self.grid_size[0] + 1, self.grid_size[1] + 1, self.grid_size[2] + 1)
 
-        self.grid = []
-        self.grid_f = []
-        for x in range(self.grid_size[0]):
-            self.grid.append([])
-            self.grid_f.append([])
-            for y in range(self.grid_size[1]):
-                self.grid[-1].append([])
-                self.grid_f[-1].append([])
-                for z in range(self.grid_size[2]):
-                    self.grid[-1][-1].append([])
-                    self.grid_f[-1][-1].append([])
-                    self.grid[-1][-1][-1] = []
-                    self.grid_f[-1][-1][-1] = []
-
-        # add all points to the voxel map
-        self.max_points_in_voxel = 0
-        for p in points:
-            idx = self.getPointIndex(p[1])
-            self.grid[idx[0]][idx[1]][idx[2]].append(p)
-            voxel_points_count = len(self.grid[idx[0]][idx[1]][idx[2]])
-            if voxel_points_count > self.max_points_in_voxel:
-                self.max_points_in_voxel = voxel_points_count
-
-        self.max_points_in_voxel_f = 0
-        for p in points_forbidden:
-            idx = self.getPointIndex(p[1])
-            self.grid_f[idx[0]][idx[1]][idx[2]].append(p)
-            voxel_points_count = len(self.grid_f[idx[0]][idx[1]][idx[2]])
-            if voxel_points_count > self.max_points_in_voxel_f:
-                self.max_points_in_voxel_f = voxel_points_count
+        self.points, self.positions, self.offsets, self.max_points_in_voxel = self.sortPoints(points, positions[:len(points)])
+        self.points_f, self.positions_f, self.offsets_f, self.max_points_in_voxel_f = self.sortPoints(points_forbidden, positions[len(points):])
 
-    def getPointsAtPoint(self, pos, radius):
+    def getVoxelPoints(self, xi, yi, zi):
+        key = (xi * self.grid_size[1] + yi) * self.grid_size[2] + zi
+        return self.points[self.offsets[key]:self.offsets[key+1]]
+
+    def getVoxelPointsForbidden(self, xi, yi, zi):
+        key = (xi * self.grid_size[1] + yi) * self.grid_size[2] + zi
+        return self.points_f[self.offsets_f[key]:self.offsets_f[key+1]]
+
+    def getVoxelsAtPoint(self, pos, radius):
+        # linearized indices of voxels that may contain points closer than
+        # radius to pos, ordered by x, y, z
         min_index = self.getPointIndexList(pos - PyKDL.Vector(radius, radius, radius))
         max_index = self.getPointIndexList(pos + PyKDL.Vector(radius, radius, radius))
         for dof in range(3):
@@ -217,59 +234,365 @@ class VoxelGrid:
             if max_index[dof] >= self.grid_size[dof]:
                 max_index[dof] = self.grid_size[dof]-1
 
-        # get the indices of voxels around the current point
-        voxel_indices = []
-        for x in range(min_index[0], max_index[0]+1):
-            for y in range(min_index[1], max_index[1]+1):
-                for z in range(min_index[2], max_index[2]+1):
-                    voxel_center = PyKDL.Vector((x+0.5) * self.voxel_size + self.dim_min[0], (y+0.5) * self.voxel_size + self.dim_min[1], (z+0.5) * self.voxel_size + self.dim_min[2])
-                    if (voxel_center-pos).Norm() > self.voxel_max_radius + radius:
-                        continue
-                    voxel_indices.append((x,y,z))
-
-        points_in_sphere = []
-        points_f_in_sphere = []
+        xi, yi, zi = np.meshgrid(np.arange(min_index[0], max_index[0]+1), np.arange(min_index[1], max_index[1]+1), np.arange(min_index[2], max_index[2]+1), indexing='ij')
+        cells = np.column_stack((xi.ravel(), yi.ravel(), zi.ravel())).astype(np.int64)
+        voxel_centers = (cells + 0.5) * self.voxel_size + np.array(self.dim_min)
+        center_dist = np.sqrt(np.sum((voxel_centers - np.array([pos[0], pos[1], pos[2]]))**2, axis=1))
+        cells = cells[center_dist <= self.voxel_max_radius + radius]
+        return (cells[:,0] * self.grid_size[1] + cells[:,1]) * self.grid_size[2] + cells[:,2]
+
+    def getIndicesInSphere(self, positions, offsets, keys, pos, radius):
+        # indices (into the sorted points) of the points from the voxels keys
+        # closer than radius to pos, and the rank of their voxel in keys
+        starts = offsets[keys]
+        counts = offsets[keys+1] - starts
+        indices = surfaceutils.expandRanges(starts, counts)
+        ranks = np.repeat(np.arange(len(keys), dtype=np.int64), counts)
+        dist = np.sqrt(np.sum((positions[indices] - np.array([pos[0], pos[1], pos[2]]))**2, axis=1))
+        close = dist < radius
+        return indices[close], ranks[close]
+
+    def getPointsAtPoint(self, pos, radius):
+        keys = self.getVoxelsAtPoint(pos, radius)
+        indices, ranks = self.getIndicesInSphere(self.positions, self.offsets, keys, pos, radius)
+        indices_f, ranks_f = self.getIndicesInSphere(self.positions_f, self.offsets_f, keys, pos, radius)
+        points_in_sphere = [self.points[i] for i in indices]
+        points_f_in_sphere = [self.points_f[i] for i in indices_f]
+
+        # configurations in the order of the first occurrence, visiting the
+        # voxels in order and the allowed points before the forbidden ones
+        points_all = points_in_sphere + points_f_in_sphere
+        order = np.argsort(np.concatenate((ranks * 2, ranks_f * 2 + 1)), kind='mergesort')
         valid_configurations = [[], [], []]
-        for idx in voxel_indices:
-            x,y,z = idx
-            for pt in self.grid[x][y][z]:
-                pt_diff = pt[1]-pos
-                dist = pt_diff.Norm()
-                if dist < radius:
-                    q = pt[4]
-                    if not q in valid_configurations[pt[0]]:
-                        valid_configurations[pt[0]].append(q)
-                    points_in_sphere.append(pt)
-
-            for pt in self.grid_f[x][y][z]:
-                pt_diff = pt[1]-pos
-                dist = pt_diff.Norm()
-                if dist < radius:
-                    q = pt[4]
-                    if not q in valid_configurations[pt[0]]:
-                        valid_configurations[pt[0]].append(q)
-                    points_f_in_sphere.append(pt)
+        configurations_set = [set(), set(), set()]
+        for i in order:
+            pt = points_all[i]
+            q = pt[4]
+            if not q in configurations_set[pt[0]]:
+                configurations_set[pt[0]].add(q)
+                valid_configurations[pt[0]].append(q)
 
         return points_in_sphere, points_f_in_sphere, valid_configurations
 
+# binary file of the self collision map: 8 bytes of magic, version, number of
+# dimensions and shape (sp, f1, f3, f2 configs counts) (uint32), bits of the
+# configurations (bit i is bit i%8 of the byte i/8, i is the C-order index of
+# (sp_idx, f1_idx, f3_idx, f2_idx))
+SELF_COLLISION_MAP_MAGIC = 'BHSCOLMP'
+SELF_COLLISION_MAP_VERSION = 1
+
+class SelfCollisionMap(object):
+    # set of self-colliding hand configurations (sp_idx, f1_idx, f3_idx, f2_idx)
+    # stored as a packed bitmap; the loaded map is memory-mapped, so all
+    # processes share one copy
+
+    def __init__(self, shape=(0, 0, 0, 0)):
+        self.shape = tuple(int(s) for s in shape)
+        self.bits = np.zeros((int(np.prod(self.shape)) + 7) // 8, dtype=np.uint8)
+        self.filename = None
+
+    def __getstate__(self):
+        # the memory-mapped map is reopened instead of being copied
+        state = self.__dict__.copy()
+        if self.filename != None:
+            state['bits'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.filename != None:
+            self.load(self.filename)
+
+    def __len__(self):
+        return int(np.unpackbits(self.bits).sum())
+
+    def __contains__(self, cf):
+        return bool(self.contains(np.array([cf]))[0])
+
+    def getLinearIndices(self, configs):
+        configs = np.asarray(configs, dtype=np.int64).reshape(-1, 4)
+        return np.ravel_multi_index((configs[:,0], configs[:,1], configs[:,2], configs[:,3]), self.shape)
+
+    def contains(self, configs):
+        # bool array, True for the self-colliding configurations of the (N,4)
+        # array of configurations
+        idx = self.getLinearIndices(configs)
+        return (self.bits[idx >> 3] >> (idx & 7).astype(np.uint8)) & 1 != 0
+
+    def add(self, configs):
+        idx = self.getLinearIndices(configs)
+        np.bitwise_or.at(self.bits, idx >> 3, np.left_shift(1, idx & 7).astype(np.uint8))
+
+    def getConfigs(self):
+        # sorted (N,4) array of the self-colliding configurations
+        idx = np.nonzero(np.unpackbits(self.bits).reshape(-1, 8)[:,::-1].ravel())[0]
+        return np.array(np.unravel_index(idx, self.shape), dtype=np.int64).T.reshape(-1, 4)
+
+    def save(self, filename):
+        header = np.array([SELF_COLLISION_MAP_VERSION, len(self.shape)] + list(self.shape), dtype='<u4')
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(SELF_COLLISION_MAP_MAGIC)
+            f.write(header.tostring())
+            f.write(np.ascontiguousarray(self.bits, dtype=np.uint8).tostring())
+        os.rename(tmp_filename, filename)
+
+    def load(self, filename):
+        with open(filename, 'rb') as f:
+            magic = f.read(len(SELF_COLLISION_MAP_MAGIC))
+            if magic != SELF_COLLISION_MAP_MAGIC:
+                raise Exception("SelfCollisionMap.load: wrong file format: %s"%(filename))
+            version, dims = np.frombuffer(f.read(8), dtype='<u4').tolist()
+            if version != SELF_COLLISION_MAP_VERSION or dims != 4:
+                raise Exception("SelfCollisionMap.load: unsupported version %s of file %s"%(version, filename))
+            shape = tuple(np.frombuffer(f.read(16), dtype='<u4').tolist())
+            offset = f.tell()
+        bits_count = (int(np.prod(shape)) + 7) // 8
+        if os.path.getsize(filename) != offset + bits_count:
+            raise Exception("SelfCollisionMap.load: wrong size of file %s"%(filename))
+        self.shape = shape
+        if bits_count == 0:
+            self.bits = np.zeros(0, dtype=np.uint8)
+        else:
+            self.bits = np.memmap(filename, dtype=np.uint8, mode='r', offset=offset, shape=(bits_count,))
+        self.filename = filename
+
+def convertSelfCollisionData(text_filename, filename, shape):
+    # converts the text file of self-colliding configurations (one
+    # "sp_idx f1_idx f3_idx f2_idx" line per configuration) to the binary map
+    configs = []
+    with open(text_filename, 'r') as f:
+        for line in f:
+            cf_str = line.split()
+            if len(cf_str) == 4:
+                configs.append( [int(cf_str[0]), int(cf_str[1]), int(cf_str[2]), int(cf_str[3])] )
+    self_collision_map = SelfCollisionMap(shape)
+    self_collision_map.add(np.array(configs, dtype=np.int64).reshape(-1, 4))
+    self_collision_map.save(filename)
+    print "self collision map: %s configurations saved to file %s"%(len(configs), filename)
+
+def loadSelfCollisionMap(text_filename, filename, shape):
+    # loads the binary map, which is converted again from the text file if it
+    # is missing, older than the text file or has a different shape; without
+    # the text file the binary map is used as it is
+    shape = tuple(int(s) for s in shape)
+    self_collision_map = SelfCollisionMap()
+    if os.path.isfile(filename) and (not os.path.isfile(text_filename) or os.path.getmtime(filename) >= os.path.getmtime(text_filename)):
+        try:
+            self_collision_map.load(filename)
+            if self_collision_map.shape == shape:
+                return self_collision_map
+        except Exception as e:
+            print e
+    convertSelfCollisionData(text_filename, filename, shape)
+    self_collision_map.load(filename)
+    return self_collision_map
+
+#
+# sets of orientations packed into arrays of uint64 words (bit i of the set
+# is bit i%64 of the word i/64)
+#
+
+def getOrientationBitsUnion(bits):
+    # union of the (K,W) array of orientation sets
+    return np.bitwise_or.reduce(np.asarray(bits, dtype=np.uint64), axis=0)
+
+def getOrientationBitsIntersection(bits):
+    # intersection of the (K,W) array of orientation sets (K > 0)
+    return np.bitwise_and.reduce(np.asarray(bits, dtype=np.uint64), axis=0)
+
+def getOrientationsFromBits(bits):
+    # sorted array of orientation indices of the set
+    bits = np.asarray(bits, dtype=np.uint64)
+    words = np.nonzero(bits)[0]
+    word_bits = (bits[words].reshape(-1, 1) >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+    word_idx, bit_idx = np.nonzero(word_bits)
+    return words[word_idx] * 64 + bit_idx
+
+def testOrientationBit(bits, ori_idx):
+    return (bits[ori_idx // 64] >> np.uint64(ori_idx % 64)) & np.uint64(1) != 0
+
+def setOrientationBit(bits, ori_idx):
+    bits[ori_idx // 64] |= np.uint64(1) << np.uint64(ori_idx % 64)
+
+def getVolumetricVoxels(rotations, translations, positions, vol_radius, vol_samples_count):
+    # (O,P) linear indices of voxels of the (P,3) points transformed by the
+    # (O,3,3) rotations and (O,3) translations; -1 for points outside the volume
+    index_factor = float(vol_samples_count)/(2.0*vol_radius)
+    pts = np.einsum('oij,pj->opi', rotations, positions) + translations.reshape(-1, 1, 3)
+    idx = np.floor(index_factor*(pts + vol_radius))
+    valid = np.all((idx >= 0) & (idx < vol_samples_count), axis=2)
+    idx = idx.astype(np.int64)
+    voxels = (idx[:,:,0] * vol_samples_count + idx[:,:,1]) * vol_samples_count + idx[:,:,2]
+    voxels[~valid] = -1
+    return voxels
+
+def accumulateVolumetricEntries(keys, pt_ids, normals, labels):
+    # accumulates the normals and the surface type votes (labels 0: plane,
+    # 1: edge, 2: point) of points pt_ids for every entry key; returns the
+    # sorted unique keys, normalized sums of normals and surface types
+    keys, inverse = np.unique(keys, return_inverse=True)
+
+    # the normals are summed in the order of points, as in the loop version
+    norm = np.column_stack([np.bincount(inverse, weights=normals[pt_ids,dim], minlength=len(keys)) for dim in range(3)])
+    norm_len = np.sqrt(np.sum(norm * norm, axis=1))
+    degenerate = norm_len < 1e-6
+    norm[degenerate] = [1.0, 0.0, 0.0]
+    norm[~degenerate] /= norm_len[~degenerate].reshape(-1, 1)
+
+    pt_labels = labels[pt_ids].astype(np.int64)
+    labeled = pt_labels < 3
+    votes = np.bincount(inverse[labeled] * 3 + pt_labels[labeled], minlength=len(keys)*3).reshape(-1, 3)
+    planes = votes[:,0]
+    edges = votes[:,1]
+    points = votes[:,2]
+    types = np.full(len(keys), 2, dtype=np.uint8)
+    types[(edges >= planes) & (edges >= points)] = 1
+    types[(planes >= edges) & (planes >= points)] = 0
+    return keys, norm, types
+
+def getVolumetricEntries(rotations, translations, positions, normals, labels, vol_radius, vol_samples_count, ori_offset=0, batch_size=1000000):
+    # transforms the (P,3) surface points by the (O,3,3) rotations and (O,3)
+    # translations and accumulates the normals and the surface type votes
+    # of the points in every voxel for every orientation; returns the entries
+    # (voxel linear index, orientation index + ori_offset, normalized sum of
+    # normals, surface type) sorted by orientation and voxel
+    points_count = len(positions)
+    voxels_count = vol_samples_count**3
+    ori_batch = max(1, batch_size // max(1, points_count))
+    result_voxels = []
+    result_oris = []
+    result_normals = []
+    result_types = []
+    for ori_begin in range(0, len(rotations), ori_batch):
+        voxels = getVolumetricVoxels(rotations[ori_begin:ori_begin+ori_batch], translations[ori_begin:ori_begin+ori_batch], positions, vol_radius, vol_samples_count)
+        oris = np.arange(ori_begin, ori_begin + len(voxels), dtype=np.int64).reshape(-1, 1)
+        valid = (voxels >= 0).ravel()
+        keys = (oris * voxels_count + voxels).ravel()[valid]
+        pt_ids = np.tile(np.arange(points_count), len(voxels))[valid]
+        if len(keys) == 0:
+            continue
+        keys, norm, types = accumulateVolumetricEntries(keys, pt_ids, normals, labels)
+        result_voxels.append(keys % voxels_count)
+        result_oris.append(keys // voxels_count + ori_offset)
+        result_normals.append(norm)
+        result_types.append(types)
+
+    if len(result_voxels) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0,3)), np.zeros(0, dtype=np.uint8)
+    return np.concatenate(result_voxels), np.concatenate(result_oris), np.concatenate(result_normals), np.concatenate(result_types)
+
+def getKeyHandleRegion(positions):
+    # contact is allowed only with the surface of the key handle
+    return positions[:,0] <= 0.0
+
+# binary file of the volumetric map: 8 bytes of magic, version,
+# vol_samples_count, orientations count, orientation words count (uint32),
+# entries count, rows count (uint64), vol_radius, orientations_angle
+# (float64), T_H_O and orientations (rotation and translation, 12 x float64
+# each), voxels of rows, entries offsets (int64), orientation bitsets
+# (uint64), entries normals (float32), voxels and orientations (int32),
+# types (uint8)
+VOLUMETRIC_MAP_MAGIC = 'BHVOLMAP'
+VOLUMETRIC_MAP_VERSION = 2
+
+def getFrameArray(T):
+    return [T.M[0,0], T.M[0,1], T.M[0,2], T.M[1,0], T.M[1,1], T.M[1,2], T.M[2,0], T.M[2,1], T.M[2,2], T.p[0], T.p[1], T.p[2]]
+
+#
+# parallel generation of the volumetric map
+#
+
+def toSharedArray(array):
+    # copies the array to the shared memory; returns a picklable (at the
+    # creation of processes) description of the shared array
+    array = np.ascontiguousarray(array)
+    shared = multiprocessing.sharedctypes.RawArray('b', max(1, array.nbytes))
+    np.frombuffer(shared, dtype=np.int8, count=array.nbytes)[:] = array.view(np.int8).ravel()
+    return (shared, array.dtype.str, array.shape)
+
+def fromSharedArray(shared_array):
+    # numpy view of the shared array (no copy)
+    shared, dtype, shape = shared_array
+    count = int(np.prod(shape))
+    return np.frombuffer(shared, dtype=dtype, count=count).reshape(shape)
+
+# read-only data of the worker processes, set by initVolumetricWorker
+volumetric_worker_data = None
+
+def initVolumetricWorker(shared_arrays, vol_radius, vol_samples_count):
+    global volumetric_worker_data
+    volumetric_worker_data = [fromSharedArray(shared_array) for shared_array in shared_arrays] + [vol_radius, vol_samples_count]
+
+def generateVolumetricShard(ori_range):
+    # entries of the volumetric map for the orientations [ori_begin, ori_end)
+    ori_begin, ori_end = ori_range
+    rotations, translations, positions, normals, labels, vol_radius, vol_samples_count = volumetric_worker_data
+    t0 = time.time()
+    entries = getVolumetricEntries(rotations[ori_begin:ori_end], translations[ori_begin:ori_end], positions, normals, labels, vol_radius, vol_samples_count, ori_offset=ori_begin)
+    return entries, time.time() - t0
+
+class VolSamplesAdapter(object):
+    # read-only vol_samples[xi][yi][zi] access to the volumetric map for the
+    # code outside of this module; the dicts {ori_idx: (normal, type)} of
+    # voxels are created on the first access from the entries of the model
+    # (which may be memory-mapped). The grasp search uses getEntryIndices
+
+    def __init__(self, vol_model, indices=()):
+        self.vol_model = vol_model
+        self.indices = indices
+        self.voxels = {}
+
+    def clear(self):
+        self.voxels = {}
+
+    def __len__(self):
+        return self.vol_model.vol_samples_count
+
+    def __getitem__(self, idx):
+        if idx < 0 or idx >= self.vol_model.vol_samples_count:
+            raise IndexError("VolSamplesAdapter: index out of range: %s"%(idx))
+        if len(self.indices) < 2:
+            adapter = VolSamplesAdapter(self.vol_model, self.indices + (idx,))
+            adapter.voxels = self.voxels
+            return adapter
+        xi, yi = self.indices
+        return self.getVoxel(self.vol_model.getVolLinearIndex(xi, yi, idx))
+
+    def getVoxel(self, vol_idx):
+        if vol_idx in self.voxels:
+            return self.voxels[vol_idx]
+        rows, found = self.vol_model.getVolRows([vol_idx])
+        if not found[0]:
+            return {}
+        vol_sample = {}
+        begin = self.vol_model.entries_offsets[rows[0]]
+        end = self.vol_model.entries_offsets[rows[0]+1]
+        oris = self.vol_model.entries_ori[begin:end].tolist()
+        normals = self.vol_model.entries_normal[begin:end].tolist()
+        types = self.vol_model.entries_type[begin:end].tolist()
+        for i in range(len(oris)):
+            vol_sample[oris[i]] = (PyKDL.Vector(normals[i][0], normals[i][1], normals[i][2]), types[i])
+        self.voxels[vol_idx] = vol_sample
+        return vol_sample
+
 class VolumetricModel:
-    def __init__(self, vol_radius, vol_samples_count, T_H_O, orientations_angle, vertices_obj, faces_obj):
+    def __init__(self, vol_radius, vol_samples_count, T_H_O, orientations_angle, vertices_obj, faces_obj, sparse=False, allowed_region=None):
         self.vol_radius = vol_radius
         self.vol_samples_count = vol_samples_count
         self.index_factor = float(self.vol_samples_count)/(2.0*self.vol_radius)
-        self.vol_samples = []
-        for x in np.linspace(-self.vol_radius, self.vol_radius, self.vol_samples_count):
-            self.vol_samples.append([])
-            for y in np.linspace(-self.vol_radius, self.vol_radius, self.vol_samples_count):
-                self.vol_samples[-1].append([])
-                for z in np.linspace(-self.vol_radius, self.vol_radius, self.vol_samples_count):
-                    self.vol_samples[-1][-1].append([])
-                    self.vol_samples[-1][-1][-1] = {}
-        self.vol_sample_points = []
-        for xi in range(self.vol_samples_count):
-            for yi in range(self.vol_samples_count):
-                for zi in range(self.vol_samples_count):
-                    self.vol_sample_points.append( self.getVolPoint(xi,yi,zi) )
+        # in the sparse mode only the occupied voxels are stored; in both
+        # modes vol_samples is served lazily from the entries
+        self.sparse = sparse
+        self.vol_samples = VolSamplesAdapter(self)
+        if self.sparse:
+            self.vol_sample_points = None
+        else:
+            self.vol_sample_points = []
+            for xi in range(self.vol_samples_count):
+                for yi in range(self.vol_samples_count):
+                    for zi in range(self.vol_samples_count):
+                        self.vol_sample_points.append( self.getVolPoint(xi,yi,zi) )
         self.T_H_O = T_H_O
         self.T_O_H = self.T_H_O.Inverse()
 
@@ -286,66 +609,20 @@ class VolumetricModel:
         self.orientations = {}
         for ori_idx in range(len(orientations2)):
             self.orientations[ori_idx] = orientations2[ori_idx]
+        self.ori_words_count = (len(self.orientations) + 63) // 64
+        self.setEntries([], [], np.zeros((0,3)), [])
 
         # generate a set of surface points
-        self.surface_points_obj = surfaceutils.sampleMeshDetailedRays(vertices_obj, faces_obj, 0.0015)
+        self.surface_points_obj = surfaceutils.sampleMeshCached(vertices_obj, faces_obj, 0.0015, curvature_radius=0.003)
         print "surface of the object has %s points"%(len(self.surface_points_obj))
 
-        # disallow contact with the surface points beyond the key handle
-        for p in self.surface_points_obj:
-            if p.pos.x() > 0.0:
-                p.allowed = False
-
-        surface_points_obj_init = []
-        surface_points2_obj_init = []
-        for sp in self.surface_points_obj:
-            if sp.allowed:
-                surface_points_obj_init.append(sp)
-            else:
-                surface_points2_obj_init.append(sp)
-
-        print "generating a subset of surface points of the object..."
-
-        while True:
-            p_idx = random.randint(0, len(self.surface_points_obj)-1)
-            if self.surface_points_obj[p_idx].allowed:
-                break
-        p_dist = 0.003
-
-        self.sampled_points_obj = []
-        while True:
-            self.sampled_points_obj.append(p_idx)
-            surface_points_obj2 = []
-            for sp in surface_points_obj_init:
-                if (sp.pos-self.surface_points_obj[p_idx].pos).Norm() > p_dist:
-                    surface_points_obj2.append(sp)
-            if len(surface_points_obj2) == 0:
-                break
-            surface_points_obj_init = surface_points_obj2
-            p_idx = surface_points_obj_init[0].id
-
-        print "subset size: %s"%(len(self.sampled_points_obj))
-
-        print "generating a subset of other surface points of the object..."
-
-        p_dist2 = 0.006
-
-        while True:
-            p_idx = random.randint(0, len(self.surface_points_obj)-1)
-            if not self.surface_points_obj[p_idx].allowed:
-                break
-
-        self.sampled_points2_obj = []
-        while True:
-            self.sampled_points2_obj.append(p_idx)
-            surface_points2_obj2 = []
-            for sp in surface_points2_obj_init:
-                if (sp.pos-self.surface_points_obj[p_idx].pos).Norm() > p_dist2:
-                    surface_points2_obj2.append(sp)
-            if len(surface_points2_obj2) == 0:
-                break
-            surface_points2_obj_init = surface_points2_obj2
-            p_idx = surface_points2_obj_init[0].id
+        # contact is allowed only with the surface points in the allowed region
+        # (by default the key handle), see setAllowedRegion
+        self.subset_neighbors = {}
+        self.point_voxels = None
+        if allowed_region is None:
+            allowed_region = getKeyHandleRegion
+        self.setAllowedRegion(allowed_region)
 
         # test volumetric model
         if False:
@@ -359,35 +636,10 @@ class VolumetricModel:
                 m_id = self.pub_marker.publishSinglePointMarker(pt.pos, m_id, r=0, g=1, b=0, namespace='default', frame_id='world', m_type=Marker.CUBE, scale=Vector3(0.003, 0.003, 0.003), T=None)
                 rospy.sleep(0.001)
 
-        print "subset size: %s"%(len(self.sampled_points2_obj))
-
-        print "calculating surface curvature at sampled points of the obj..."
-        m_id = 0
-        planes = 0
-        edges = 0
-        points = 0
-        for pt_idx in range(len(self.surface_points_obj)):
-            indices, nx, pc1, pc2 = surfaceutils.pclPrincipalCurvaturesEstimation(self.surface_points_obj, pt_idx, 5, 0.003)
-#            m_id = self.pub_marker.publishVectorMarker(self.T_W_O * self.surface_points_obj[pt_idx].pos, self.T_W_O * (self.surface_points_obj[pt_idx].pos + nx*0.004), m_id, 1, 0, 0, frame='world', namespace='default', scale=0.0002)
-#            m_id = self.pub_marker.publishVectorMarker(self.T_W_O * self.surface_points_obj[pt_idx].pos, self.T_W_O * (self.surface_points_obj[pt_idx].pos + self.surface_points_obj[pt_idx].normal*0.004), m_id, 0, 0, 1, frame='world', namespace='default', scale=0.0002)
-            self.surface_points_obj[pt_idx].frame = PyKDL.Frame(PyKDL.Rotation(nx, self.surface_points_obj[pt_idx].normal * nx, self.surface_points_obj[pt_idx].normal), self.surface_points_obj[pt_idx].pos)
-            self.surface_points_obj[pt_idx].pc1 = pc1
-            self.surface_points_obj[pt_idx].pc2 = pc2
-            if pc1 < 0.2:
-                self.surface_points_obj[pt_idx].is_plane = True
-                self.surface_points_obj[pt_idx].is_edge = False
-                self.surface_points_obj[pt_idx].is_point = False
-                planes += 1
-            elif pc2 < 0.2:
-                self.surface_points_obj[pt_idx].is_plane = False
-                self.surface_points_obj[pt_idx].is_edge = True
-                self.surface_points_obj[pt_idx].is_point = False
-                edges += 1
-            else:
-                self.surface_points_obj[pt_idx].is_plane = False
-                self.surface_points_obj[pt_idx].is_edge = False
-                self.surface_points_obj[pt_idx].is_point = True
-                points += 1
+        labels = self.surface_points_obj.surface_type
+        planes = np.sum(labels == 0)
+        edges = np.sum(labels == 1)
+        points = np.sum(labels == 2)
 
         print "obj planes: %s  edges: %s  points: %s"%(planes, edges, points)
 
@@ -401,6 +653,163 @@ class VolumetricModel:
 
 
 
+    def getSeparatedSubset(self, p_dist, mask):
+        # the neighbors of all surface points are computed once for every p_dist
+        positions = self.surface_points_obj.positions
+        if not p_dist in self.subset_neighbors:
+            self.subset_neighbors[p_dist] = surfaceutils.getRadiusNeighbors(positions, p_dist, inclusive=True)
+        return surfaceutils.getSeparatedSubset(positions, p_dist, mask=mask, neighbors=self.subset_neighbors[p_dist])
+
+    def setAllowedRegion(self, allowed_region):
+        # allowed_region is a predicate on the (N,3) array of surface points
+        # positions or a mask of surface points; the subsets of the surface
+        # and the volumetric map (if it is generated or loaded) are updated
+        # reusing the surface and its curvature
+        if callable(allowed_region):
+            allowed = np.asarray(allowed_region(np.asarray(self.surface_points_obj.positions)), dtype=bool)
+        else:
+            allowed = np.asarray(allowed_region, dtype=bool)
+        changed = allowed != self.surface_points_obj.allowed
+        self.surface_points_obj.allowed[:] = allowed
+
+        print "generating a subset of surface points of the object..."
+        self.sampled_points_obj = self.getSeparatedSubset(0.003, allowed)
+        print "subset size: %s"%(len(self.sampled_points_obj))
+
+        print "generating a subset of other surface points of the object..."
+        self.sampled_points2_obj = self.getSeparatedSubset(0.006, np.logical_not(allowed))
+        print "subset size: %s"%(len(self.sampled_points2_obj))
+
+        if len(self.entries_voxel) > 0 and np.any(changed):
+            self.updateVolumetricMap(changed)
+
+    def getPointVoxels(self):
+        # (O,P) voxels of all surface points for all orientations (-1 outside
+        # the volume), computed once
+        if self.point_voxels is None:
+            rotations, translations = self.getOrientationsArrays()
+            positions = np.asarray(self.surface_points_obj.positions)
+            self.point_voxels = np.zeros((len(rotations), len(positions)), dtype=np.int32)
+            ori_batch = max(1, 1000000 // max(1, len(positions)))
+            for ori_begin in range(0, len(rotations), ori_batch):
+                self.point_voxels[ori_begin:ori_begin+ori_batch] = getVolumetricVoxels(rotations[ori_begin:ori_begin+ori_batch], translations[ori_begin:ori_begin+ori_batch], positions, self.vol_radius, self.vol_samples_count)
+        return self.point_voxels
+
+    def updateVolumetricMap(self, changed):
+        # recomputes only the entries that contain the surface points whose
+        # allowed flag has changed (mask); the result is the same as for
+        # generate with the current allowed points
+        cloud = self.surface_points_obj
+        point_voxels = self.getPointVoxels()
+        voxels_count = self.vol_samples_count**3
+        oris = np.arange(len(point_voxels), dtype=np.int64).reshape(-1, 1)
+        changed_voxels = point_voxels[:, np.nonzero(changed)[0]]
+        affected = np.unique((oris * voxels_count + changed_voxels)[changed_voxels >= 0])
+
+        allowed_ids = np.nonzero(cloud.allowed)[0]
+        allowed_voxels = point_voxels[:, allowed_ids]
+        valid = (allowed_voxels >= 0).ravel()
+        keys = (oris * voxels_count + allowed_voxels).ravel()[valid]
+        pt_ids = np.tile(allowed_ids, len(point_voxels))[valid]
+        in_affected = np.in1d(keys, affected)
+        keys, normals, types = accumulateVolumetricEntries(keys[in_affected], pt_ids[in_affected], np.asarray(cloud.normals, dtype=np.float64), cloud.surface_type)
+
+        keep = np.logical_not(np.in1d(self.entries_ori.astype(np.int64) * voxels_count + self.entries_voxel, affected))
+        voxels = np.concatenate((self.entries_voxel[keep], keys % voxels_count))
+        oris = np.concatenate((self.entries_ori[keep], keys // voxels_count))
+        normals = np.concatenate((np.asarray(self.entries_normal[keep], dtype=np.float64), normals))
+        types = np.concatenate((self.entries_type[keep], types))
+        print "volumetric map update: %s entries recomputed, %s entries"%(len(affected), len(voxels))
+        self.setEntries(voxels, oris, normals, types)
+        self.resetVolSamples()
+
+    def getVolLinearIndex(self, xi, yi, zi):
+        return (xi * self.vol_samples_count + yi) * self.vol_samples_count + zi
+
+    def setEntries(self, voxels, oris, normals, types):
+        # dense representation of the volumetric map: vol_bits[r] is the set
+        # of orientations with the surface in the voxel of row r, and the
+        # (voxel, orientation) entries sorted by voxel and orientation with
+        # float32 normals and uint8 surface types; the entries of the row r
+        # are in the range [entries_offsets[r], entries_offsets[r+1]).
+        # Rows are all voxels (linear indices), or only the occupied voxels
+        # vol_rows (sorted) in the sparse mode
+        voxels = np.asarray(voxels, dtype=np.int32)
+        oris = np.asarray(oris, dtype=np.int32)
+        order = np.lexsort((oris, voxels))
+        self.entries_voxel = voxels[order]
+        self.entries_ori = oris[order]
+        self.entries_normal = np.asarray(normals, dtype=np.float32).reshape(-1, 3)[order]
+        self.entries_type = np.asarray(types, dtype=np.uint8)[order]
+        if self.sparse:
+            self.vol_rows = np.unique(self.entries_voxel).astype(np.int64)
+            rows = np.searchsorted(self.vol_rows, self.entries_voxel)
+            rows_count = len(self.vol_rows)
+        else:
+            self.vol_rows = None
+            rows = self.entries_voxel
+            rows_count = self.vol_samples_count**3
+        self.entries_offsets = np.zeros(rows_count+1, dtype=np.int64)
+        self.entries_offsets[1:] = np.cumsum(np.bincount(rows, minlength=rows_count))
+        self.vol_bits = np.zeros((rows_count, self.ori_words_count), dtype=np.uint64)
+        np.bitwise_or.at(self.vol_bits, (rows, self.entries_ori // 64), np.left_shift(np.uint64(1), (self.entries_ori % 64).astype(np.uint64)))
+        self.setEntriesKeys()
+
+    def setEntriesKeys(self):
+        # sorted keys voxel * orientations count + orientation of the entries
+        self.entries_key = self.entries_voxel.astype(np.int64) * len(self.orientations) + self.entries_ori
+
+    def getEntryIndices(self, vol_indices, ori_idx):
+        # indices of the entries of the orientation in the voxels (linear
+        # indices), -1 for the voxels without the surface for the orientation
+        # and for the negative (invalid) voxel indices
+        keys = np.asarray(vol_indices, dtype=np.int64).reshape(-1) * len(self.orientations) + ori_idx
+        if len(self.entries_key) == 0:
+            return np.zeros(len(keys), dtype=np.int64) - 1
+        idx = np.minimum(np.searchsorted(self.entries_key, keys), len(self.entries_key)-1)
+        return np.where(self.entries_key[idx] == keys, idx, -1)
+
+    def getVolRows(self, vol_indices):
+        # rows of vol_bits and entries_offsets for the voxels (linear indices)
+        # and the mask of voxels that have rows
+        vol_indices = np.asarray(vol_indices, dtype=np.int64).reshape(-1)
+        if self.vol_rows is None:
+            return vol_indices, np.ones(len(vol_indices), dtype=bool)
+        if len(self.vol_rows) == 0:
+            return np.zeros(len(vol_indices), dtype=np.int64), np.zeros(len(vol_indices), dtype=bool)
+        rows = np.minimum(np.searchsorted(self.vol_rows, vol_indices), len(self.vol_rows)-1)
+        return rows, self.vol_rows[rows] == vol_indices
+
+    def getEmptyOrientationBits(self):
+        return np.zeros(self.ori_words_count, dtype=np.uint64)
+
+    def getOrientationBits(self, vol_indices):
+        # union of the orientation sets of the voxels (linear indices)
+        rows, found = self.getVolRows(vol_indices)
+        return getOrientationBitsUnion(self.vol_bits[rows[found]])
+
+    def memoryUsage(self):
+        # bytes used by the arrays of the map and (without their contents) by
+        # the containers of vol_samples and vol_sample_points
+        arrays = [self.vol_bits, self.entries_offsets, self.entries_voxel, self.entries_ori, self.entries_normal, self.entries_type, self.entries_key]
+        if self.vol_rows is not None:
+            arrays.append(self.vol_rows)
+        size = sum([a.nbytes for a in arrays])
+        size += sys.getsizeof(self.vol_samples.voxels)
+        for vol_sample in self.vol_samples.voxels.values():
+            size += sys.getsizeof(vol_sample)
+        if not self.sparse:
+            size += sys.getsizeof(self.vol_sample_points) + sum([sys.getsizeof(pt) for pt in self.vol_sample_points])
+        return size
+
+    def getVolSamplePoints(self):
+        # centers of all voxels, or of the occupied voxels in the sparse mode
+        if not self.sparse:
+            return self.vol_sample_points
+        vol_count = self.vol_samples_count
+        indices = np.column_stack((self.vol_rows // (vol_count * vol_count), (self.vol_rows // vol_count) % vol_count, self.vol_rows % vol_count))
+        return [PyKDL.Vector(pt[0], pt[1], pt[2]) for pt in self.getVolPoints(indices).tolist()]
+
     def getVolIndex(self, pt):
         xi = int(np.floor( self.index_factor*(pt[0]+self.vol_radius) ))
         yi = int(np.floor( self.index_factor*(pt[1]+self.vol_radius) ))
@@ -413,64 +822,189 @@ class VolumetricModel:
     def getVolPoint(self, xi,yi,zi):
         return PyKDL.Vector(-self.vol_radius + (xi+0.5) / self.index_factor, -self.vol_radius + (yi+0.5) / self.index_factor, -self.vol_radius + (zi+0.5) / self.index_factor)
 
-    def generate(self):
-
-        for ori_idx in range(len(orientations)):
-                    T_H_Hd = orientations[ori_idx]
-                    T_H_Od = T_H_Hd * self.T_H_O
-                    for surf_pt_idx in range(len(self.surface_points_obj)):
-                        surf_pt = self.surface_points_obj[surf_pt_idx]
-                        if not surf_pt.allowed:
-                            continue
-                        pt = T_H_Od * surf_pt.pos
-                        vol_idx = self.getVolIndex(pt)
-                        if vol_idx != None:
-                            if not ori_idx in self.vol_samples[vol_idx[0]][vol_idx[1]][vol_idx[2]]:
-                                self.vol_samples[vol_idx[0]][vol_idx[1]][vol_idx[2]][ori_idx] = [surf_pt.id]
-                            else:
-                                self.vol_samples[vol_idx[0]][vol_idx[1]][vol_idx[2]][ori_idx].append(surf_pt.id)
-        print "transforming the volumetric map..."
-
-        for xi in range(self.vol_samples_count):
-                  print xi
-                  for yi in range(self.vol_samples_count):
-                    for zi in range(self.vol_samples_count):
-                      for ori in self.vol_samples[xi][yi][zi]:
-                          planes = 0
-                          edges = 0
-                          points = 0
-                          norm = PyKDL.Vector()
-                          for pt_id in self.vol_samples[xi][yi][zi][ori]:
-                              norm += self.surface_points_obj[pt_id].normal
-                              if self.surface_points_obj[pt_id].is_plane:
-                                  planes += 1
-                              if self.surface_points_obj[pt_id].is_edge:
-                                  edges += 1
-                              if self.surface_points_obj[pt_id].is_point:
-                                  points += 1
-                          norm.Normalize()
-                          if planes >= edges and planes >= points:
-                              self.vol_samples[xi][yi][zi][ori] = (norm, 0)
-                          elif edges >= planes and edges >= points:
-                              self.vol_samples[xi][yi][zi][ori] = (norm, 1)
-                          else:
-                              self.vol_samples[xi][yi][zi][ori] = (norm, 2)
+    def getVolIndices(self, points):
+        # batch version of getVolIndex for the (N,3) array of points: returns
+        # the (N,3) array of indices and the mask of points inside the volume
+        # (indices of other points are not valid)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        indices = np.floor( self.index_factor*(points+self.vol_radius) )
+        valid = np.all((indices >= 0) & (indices < self.vol_samples_count), axis=1)
+        return indices.astype(np.int64), valid
+
+    def getVolPoints(self, indices):
+        # batch version of getVolPoint: centers of the voxels (N,3)
+        indices = np.asarray(indices, dtype=np.float64).reshape(-1, 3)
+        return -self.vol_radius + (indices+0.5) / self.index_factor
+
+    def getOrientationsArrays(self):
+        # rotations (O,3,3) and translations (O,3) of orientations * T_H_O
+        ori_count = len(self.orientations)
+        rotations = np.zeros((ori_count, 3, 3))
+        translations = np.zeros((ori_count, 3))
+        for ori_idx in range(ori_count):
+            T_H_Od = self.orientations[ori_idx] * self.T_H_O
+            for i in range(3):
+                translations[ori_idx, i] = T_H_Od.p[i]
+                for j in range(3):
+                    rotations[ori_idx, i, j] = T_H_Od.M[i, j]
+        return rotations, translations
+
+    def resetVolSamples(self):
+        # the dicts of vol_samples are created again from the new entries
+        self.vol_samples.clear()
+
+    def generate(self, workers_count=1, shards_count=None):
+        # all allowed surface points are transformed by all orientations in
+        # batches; points outside the volume are skipped. If workers_count > 1,
+        # the orientations are split into shards processed by a pool of
+        # processes, and the result is the same as for the serial version
+        cloud = self.surface_points_obj
+        allowed_ids = np.nonzero(cloud.allowed)[0]
+        rotations, translations = self.getOrientationsArrays()
+        positions = cloud.positions[allowed_ids]
+        normals = cloud.normals[allowed_ids].astype(np.float64)
+        labels = cloud.surface_type[allowed_ids]
+        if workers_count > 1:
+            voxels, oris, normals, types = self.generateParallel(rotations, translations, positions, normals, labels, workers_count, shards_count)
+        else:
+            voxels, oris, normals, types = getVolumetricEntries(rotations, translations, positions, normals, labels, self.vol_radius, self.vol_samples_count)
+        print "volumetric map has %s entries"%(len(voxels))
+        self.setEntries(voxels, oris, normals, types)
+        self.resetVolSamples()
+        print "volumetric map memory: %s bytes"%(self.memoryUsage())
+
+    def generateParallel(self, rotations, translations, positions, normals, labels, workers_count, shards_count=None):
+        # the arrays are passed to the workers through the shared memory;
+        # the partial results are merged in the order of shards
+        if shards_count == None:
+            shards_count = workers_count * 4
+        ori_count = len(rotations)
+        bounds = np.linspace(0, ori_count, min(shards_count, max(1, ori_count)) + 1).astype(np.int64).tolist()
+        ori_ranges = [(bounds[i], bounds[i+1]) for i in range(len(bounds)-1)]
+        shared_arrays = [toSharedArray(array) for array in (rotations, translations, positions, normals, labels)]
+
+        pool = multiprocessing.Pool(workers_count, initializer=initVolumetricWorker, initargs=(shared_arrays, self.vol_radius, self.vol_samples_count))
+        try:
+            results = pool.map(generateVolumetricShard, ori_ranges, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        for shard_idx in range(len(ori_ranges)):
+            entries, shard_time = results[shard_idx]
+            print "volumetric map shard %s: orientations %s-%s, entries: %s, time: %ss"%(shard_idx, ori_ranges[shard_idx][0], ori_ranges[shard_idx][1]-1, len(entries[0]), shard_time)
+        return [np.concatenate([entries[i] for entries, shard_time in results]) for i in range(4)]
 
     def save(self, filename):
-        print "saving the volumetric map to file %s"%(vol_map_filename)
+        print "saving the volumetric map to file %s"%(filename)
+        header = np.array([VOLUMETRIC_MAP_VERSION, self.vol_samples_count, len(self.orientations), self.ori_words_count], dtype='<u4')
+        orientations = np.array([getFrameArray(self.orientations[ori_idx]) for ori_idx in range(len(self.orientations))], dtype='<f8').reshape(-1, 12)
+
+        # write to a temporary file first, so other processes never see partial data
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(VOLUMETRIC_MAP_MAGIC)
+            f.write(header.tostring())
+            f.write(np.array([len(self.entries_voxel), len(self.vol_bits)], dtype='<u8').tostring())
+            f.write(np.array([self.vol_radius, self.orientations_angle], dtype='<f8').tostring())
+            f.write(np.array(getFrameArray(self.T_H_O), dtype='<f8').tostring())
+            f.write(orientations.tostring())
+            if self.vol_rows is None:
+                f.write(np.arange(len(self.vol_bits), dtype='<i8').tostring())
+            else:
+                f.write(np.ascontiguousarray(self.vol_rows, dtype='<i8').tostring())
+            f.write(np.ascontiguousarray(self.entries_offsets, dtype='<i8').tostring())
+            f.write(np.ascontiguousarray(self.vol_bits, dtype='<u8').tostring())
+            f.write(np.ascontiguousarray(self.entries_normal, dtype='<f4').tostring())
+            f.write(np.ascontiguousarray(self.entries_voxel, dtype='<i4').tostring())
+            f.write(np.ascontiguousarray(self.entries_ori, dtype='<i4').tostring())
+            f.write(np.ascontiguousarray(self.entries_type, dtype='<u1').tostring())
+        os.rename(tmp_filename, filename)
+
+    def load(self, filename):
+        # memory-maps the binary volumetric map (the pages are shared between
+        # processes); text files written by saveText are also accepted
+        with open(filename, 'rb') as f:
+            magic = f.read(len(VOLUMETRIC_MAP_MAGIC))
+            if magic == VOLUMETRIC_MAP_MAGIC:
+                header = np.frombuffer(f.read(16), dtype='<u4')
+                entries_count, rows_count = np.frombuffer(f.read(16), dtype='<u8').tolist()
+                vol_radius, orientations_angle = np.frombuffer(f.read(16), dtype='<f8')
+                T_H_O = np.frombuffer(f.read(96), dtype='<f8')
+                orientations = np.frombuffer(f.read(96 * int(header[2])), dtype='<f8').reshape(-1, 12)
+                offset = f.tell()
+        if magic != VOLUMETRIC_MAP_MAGIC:
+            self.loadText(filename)
+            return
+
+        version, vol_samples_count, ori_count, ori_words_count = header.tolist()
+        if version != VOLUMETRIC_MAP_VERSION:
+            print "error: VolumetricModel.load: wrong version of file %s: %s"%(filename, version)
+            return
+        if vol_radius != self.vol_radius:
+            print "error: VolumetricModel.load: vol_radius != self.vol_radius"
+            return
+        if vol_samples_count != self.vol_samples_count:
+            print "error: VolumetricModel.load: vol_samples_count != self.vol_samples_count"
+            return
+        if ori_count != len(self.orientations) or ori_words_count != self.ori_words_count:
+            print "error: VolumetricModel.load: len(orientations) != len(self.orientations)"
+            return
+        if not np.allclose(T_H_O, getFrameArray(self.T_H_O), rtol=0.0, atol=1e-9):
+            print "error: VolumetricModel.load: T_H_O != self.T_H_O"
+            return
+        self_orientations = np.array([getFrameArray(self.orientations[ori_idx]) for ori_idx in range(ori_count)]).reshape(-1, 12)
+        if not np.allclose(orientations, self_orientations, rtol=0.0, atol=1e-9):
+            print "error: VolumetricModel.load: orientations != self.orientations"
+            return
+
+        arrays = []
+        for dtype, shape in (('<i8', (rows_count,)), ('<i8', (rows_count+1,)), ('<u8', (rows_count, ori_words_count)), ('<f4', (entries_count, 3)), ('<i4', (entries_count,)), ('<i4', (entries_count,)), ('<u1', (entries_count,))):
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            if size == 0:
+                arrays.append(np.zeros(shape, dtype=dtype))
+            else:
+                arrays.append(np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape))
+            offset += size
+        vol_rows, entries_offsets, vol_bits, entries_normal, entries_voxel, entries_ori, entries_type = arrays
+
+        # rows of all voxels are used directly by the dense model, occupied
+        # voxels by the sparse one; otherwise the rows are rebuilt
+        if self.sparse or rows_count == self.vol_samples_count**3:
+            self.vol_rows = vol_rows if self.sparse else None
+            self.entries_offsets = entries_offsets
+            self.vol_bits = vol_bits
+            self.entries_normal = entries_normal
+            self.entries_voxel = entries_voxel
+            self.entries_ori = entries_ori
+            self.entries_type = entries_type
+            self.setEntriesKeys()
+        else:
+            self.setEntries(entries_voxel, entries_ori, entries_normal, entries_type)
+        self.resetVolSamples()
+        print "volumetric map memory: %s bytes"%(self.memoryUsage())
+
+    def saveText(self, filename):
+        print "saving the volumetric map to file %s"%(filename)
         with open(filename, 'w') as f:
                     f.write(str(self.vol_radius) + " " + str(self.vol_samples_count) + "\n")
-                    for xi in range(self.vol_samples_count):
-                      for yi in range(self.vol_samples_count):
-                        for zi in range(self.vol_samples_count):
-                            if len(self.vol_samples[xi][yi][zi]) > 0:
-                                f.write(str(xi) + " " + str(yi) + " " + str(zi))
-                                for ori_idx in self.vol_samples[xi][yi][zi]:
-                                    norm, type_surf = self.vol_samples[xi][yi][zi][ori_idx]
-                                    f.write(" " + str(ori_idx) + " " + str(norm[0]) + " " + str(norm[1]) + " " + str(norm[2]) + " " + str(type_surf))
+                    # the entries are sorted by voxel, one line for each voxel
+                    voxels = self.entries_voxel.tolist()
+                    oris = self.entries_ori.tolist()
+                    normals = self.entries_normal.tolist()
+                    types = self.entries_type.tolist()
+                    vol_count = self.vol_samples_count
+                    for i in range(len(voxels)):
+                        if i == 0 or voxels[i] != voxels[i-1]:
+                            if i > 0:
                                 f.write("\n")
+                            f.write(str(voxels[i] // (vol_count * vol_count)) + " " + str((voxels[i] // vol_count) % vol_count) + " " + str(voxels[i] % vol_count))
+                        norm = normals[i]
+                        f.write(" " + str(oris[i]) + " " + str(norm[0]) + " " + str(norm[1]) + " " + str(norm[2]) + " " + str(types[i]))
+                    if len(voxels) > 0:
+                        f.write("\n")
 
-    def load(self, filename):
+    def loadText(self, filename):
         with open(filename, 'r') as f:
                     line = f.readline()
                     vol_radius_str, vol_samples_count_str = line.split()
@@ -482,6 +1016,10 @@ class VolumetricModel:
                     if vol_samples_count != self.vol_samples_count:
                         print "error: VolumetricModel.load: vol_samples_count != self.vol_samples_count"
                         return
+                    voxels = []
+                    oris = []
+                    normals = []
+                    types = []
                     while True:
                         line = f.readline()
                         val_str = line.split()
@@ -491,12 +1029,13 @@ class VolumetricModel:
                         yi = int(val_str[1])
                         zi = int(val_str[2])
                         for i in range(3, len(val_str), 5):
-                            ori_idx = int(val_str[i])
-                            normx = float(val_str[i+1])
-                            normy = float(val_str[i+2])
-                            normz = float(val_str[i+3])
-                            type_surf = int(val_str[i+4])
-                            self.vol_samples[xi][yi][zi][ori_idx] = (PyKDL.Vector(normx, normy, normz), type_surf)
+                            voxels.append(self.getVolLinearIndex(xi, yi, zi))
+                            oris.append(int(val_str[i]))
+                            normals.append([float(val_str[i+1]), float(val_str[i+2]), float(val_str[i+3])])
+                            types.append(int(val_str[i+4]))
+        normals = np.array(normals).reshape(-1, 3)
+        self.setEntries(voxels, oris, normals, types)
+        self.resetVolSamples()
 
     def test1(self, pub_marker, T_W_H):
         scale = 2.0*self.vol_radius/self.vol_samples_count
@@ -505,9 +1044,9 @@ class VolumetricModel:
             m_id = 0
             T_W_O = T_W_H * self.orientations[ori_idx] * self.T_H_O
             m_id = pub_marker.publishConstantMeshMarker("package://barrett_hand_defs/meshes/objects/klucz_gerda_binary.stl", m_id, r=1, g=0, b=0, scale=1.0, frame_id='world', namespace='default', T=T_W_O)
-            for pt in self.vol_sample_points:
+            for pt in self.getVolSamplePoints():
                 vol_idx = self.getVolIndex(pt)
-                if vol_idx != None and ori_idx in self.vol_samples[vol_idx[0]][vol_idx[1]][vol_idx[2]]:
+                if vol_idx != None and self.getEntryIndices([self.getVolLinearIndex(vol_idx[0], vol_idx[1], vol_idx[2])], ori_idx)[0] >= 0:
                     m_id = pub_marker.publishSinglePointMarker(pt, m_id, r=1, g=1, b=1, namespace='default', frame_id='world', m_type=Marker.CUBE, scale=Vector3(scale, scale, scale), T=T_W_H)
                     rospy.sleep(0.001)
             raw_input("Press ENTER to continue...")